@@ -51,10 +51,16 @@ void output_mandelbrot(int* p, int nx, int ny) {
   fclose(fp);
 }
 
-void output_mlog() {
-  FILE *fp = fopen("mlog.txt", "w");
-  mlog_flush_all(&g_md, fp);
-  fclose(fp);
+void output_mlog(int binary) {
+  if (binary) {
+    FILE *fp = fopen("mlog.bin", "wb");
+    mlog_flush_binary_all(&g_md, fp, stderr);
+    fclose(fp);
+  } else {
+    FILE *fp = fopen("mlog.txt", "w");
+    mlog_flush_all(&g_md, fp);
+    fclose(fp);
+  }
 }
 
 int main(int argc, char* argv[]) {
@@ -62,6 +68,7 @@ int main(int argc, char* argv[]) {
   int ny = 2000;
   int depth = 100;
   double scale = 2.0;
+  int binary = 0;
 
   int n_threads;
 #pragma omp parallel
@@ -73,7 +80,7 @@ int main(int argc, char* argv[]) {
 
   int opt;
   extern char *optarg;
-  while ((opt = getopt(argc, argv, "x:y:d:s:h")) != EOF) {
+  while ((opt = getopt(argc, argv, "x:y:d:s:bh")) != EOF) {
     switch (opt) {
       case 'x':
         nx = atoi(optarg);
@@ -87,9 +94,12 @@ int main(int argc, char* argv[]) {
       case 's':
         scale = atof(optarg);
         break;
+      case 'b':
+        binary = 1;
+        break;
       case 'h':
       default:
-        printf("Usage: ./chol -x <nx> -y <ny> -d <depth> -s <scale>\n");
+        printf("Usage: ./chol -x <nx> -y <ny> -d <depth> -s <scale> [-b]\n");
         exit(1);
     }
   }
@@ -99,7 +109,7 @@ int main(int argc, char* argv[]) {
   mandelbrot_parallel(p, nx, ny, depth, scale);
 
   output_mandelbrot(p, nx, ny);
-  output_mlog();
+  output_mlog(binary);
 
   return 0;
 }
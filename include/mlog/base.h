@@ -40,6 +40,10 @@ mlog_data_t;
 
 typedef void* (*mlog_decoder_t)(FILE*, int, int, void*, void*);
 
+/* Written by mlog_end_tl() in place of a decoder to mark timeline events. Unlike the address of
+ * a (static inline) decoder, it is the same in every translation unit and shared object. */
+#define MLOG_DECODER_TL ((mlog_decoder_t)(uintptr_t)1)
+
 /*
  * mlog_init
  */
@@ -262,12 +266,25 @@ static inline int _mlog_get_rank_from_begin_ptr(mlog_data_t* md, void* begin_ptr
   return -1;
 }
 
+static inline void* mlog_default_decoder_tl(FILE* stream, int rank0, int rank1, void* buf0, void* buf1) {
+  uint64_t t0         = MLOG_READ_ARG(&buf0, uint64_t);
+
+  uint64_t t1         = MLOG_READ_ARG(&buf1, uint64_t);
+  char*    event_name = MLOG_READ_ARG(&buf1, char*);
+
+  fprintf(stream, "%d,%lu,%d,%lu,%s\n", rank0, t0, rank1, t1, event_name);
+  return buf1;
+}
+
 static inline void mlog_flush(mlog_data_t* md, int rank, FILE* stream) {
   void* cur_end_buffer = md->end_buf[rank].first;
   while (cur_end_buffer < md->end_buf[rank].last) {
     void* begin_ptr = MLOG_READ_ARG(&cur_end_buffer, void*);
     if (begin_ptr) {
       mlog_decoder_t decoder = MLOG_READ_ARG(&cur_end_buffer, mlog_decoder_t);
+      if (decoder == MLOG_DECODER_TL) {
+        decoder = mlog_default_decoder_tl;
+      }
       void*          buf0    = begin_ptr;
       void*          buf1    = cur_end_buffer;
       int            rank0   = _mlog_get_rank_from_begin_ptr(md, begin_ptr);
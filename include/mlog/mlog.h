@@ -5,6 +5,8 @@
 #include "mlog/base.h"
 #include "mlog/time.h"
 
+#include <string.h>
+
 #ifdef __cplusplus
 extern "C" {
 #endif
@@ -13,23 +15,177 @@ extern "C" {
  * High level functions
  */
 
-static inline void* mlog_default_decoder_tl(FILE* stream, int rank0, int rank1, void* buf0, void* buf1) {
-  uint64_t t0         = MLOG_READ_ARG(&buf0, uint64_t);
-
-  uint64_t t1         = MLOG_READ_ARG(&buf1, uint64_t);
-  char*    event_name = MLOG_READ_ARG(&buf1, char*);
-
-  fprintf(stream, "%d,%lu,%d,%lu,%s\n", rank0, t0, rank1, t1, event_name);
-  return buf1;
-}
-
 static inline void* mlog_begin_tl(mlog_data_t* md, int rank) {
   void* ret = MLOG_BEGIN(md, rank, mlog_clock_gettime_in_nsec());
   return ret;
 }
 
 static inline void mlog_end_tl(mlog_data_t* md, int rank, void* begin_ptr, const char* event_name) {
-  MLOG_END(md, rank, begin_ptr, mlog_default_decoder_tl, mlog_clock_gettime_in_nsec(), event_name);
+  MLOG_END(md, rank, begin_ptr, MLOG_DECODER_TL, mlog_clock_gettime_in_nsec(), event_name);
+}
+
+/*
+ * Binary output
+ */
+
+#define MLOG_BINARY_MAGIC "MLOGBIN1"
+
+typedef struct mlog_binary_header {
+  char     magic[8];
+  uint64_t num_kinds;
+  uint64_t num_records;
+}
+mlog_binary_header_t;
+
+typedef struct mlog_binary_record {
+  int32_t  rank0;
+  int32_t  rank1;
+  uint64_t t0;
+  uint64_t t1;
+  uint64_t kind;
+}
+mlog_binary_record_t;
+
+typedef struct mlog_binary_writer {
+  mlog_binary_record_t* records;
+  size_t                num_records;
+  size_t                records_capacity;
+  const char**          kinds;
+  size_t                num_kinds;
+  size_t*               kind_table; /* open addressing (kind id + 1, or 0 if empty) */
+  size_t                kind_table_size;
+}
+mlog_binary_writer_t;
+
+static inline void* _mlog_binary_realloc(void* p, size_t size) {
+  void* next = realloc(p, size);
+  if (next == NULL) {
+    perror("realloc");
+    abort();
+  }
+  return next;
+}
+
+static inline void _mlog_binary_writer_init(mlog_binary_writer_t* w) {
+  w->records          = NULL;
+  w->num_records      = 0;
+  w->records_capacity = 0;
+  w->kinds            = NULL;
+  w->num_kinds        = 0;
+  w->kind_table_size  = 64;
+  w->kind_table       = (size_t*)calloc(w->kind_table_size, sizeof(size_t));
+  if (w->kind_table == NULL) {
+    perror("calloc");
+    abort();
+  }
+}
+
+static inline void _mlog_binary_writer_destroy(mlog_binary_writer_t* w) {
+  free(w->records);
+  free(w->kinds);
+  free(w->kind_table);
+}
+
+static inline size_t _mlog_binary_kind_slot(mlog_binary_writer_t* w, const char* kind) {
+  size_t mask = w->kind_table_size - 1;
+  size_t slot = (size_t)(((uintptr_t)kind >> 3) * 0x9E3779B97F4A7C15ULL) & mask;
+  while (w->kind_table[slot] != 0 && w->kinds[w->kind_table[slot] - 1] != kind) {
+    slot = (slot + 1) & mask;
+  }
+  return slot;
+}
+
+/* Kinds are interned by pointer; the viewer merges kinds with the same name. */
+static inline uint64_t _mlog_binary_kind_id(mlog_binary_writer_t* w, const char* kind) {
+  size_t slot = _mlog_binary_kind_slot(w, kind);
+  if (w->kind_table[slot] != 0) {
+    return w->kind_table[slot] - 1;
+  }
+  w->kinds = (const char**)_mlog_binary_realloc(w->kinds, (w->num_kinds + 1) * sizeof(const char*));
+  w->kinds[w->num_kinds++] = kind;
+  w->kind_table[slot] = w->num_kinds;
+  if (w->num_kinds * 2 > w->kind_table_size) {
+    free(w->kind_table);
+    w->kind_table_size *= 2;
+    w->kind_table = (size_t*)calloc(w->kind_table_size, sizeof(size_t));
+    if (w->kind_table == NULL) {
+      perror("calloc");
+      abort();
+    }
+    for (size_t i = 0; i < w->num_kinds; i++) {
+      w->kind_table[_mlog_binary_kind_slot(w, w->kinds[i])] = i + 1;
+    }
+  }
+  return w->num_kinds - 1;
+}
+
+static inline void _mlog_binary_collect(mlog_data_t* md, int rank, mlog_binary_writer_t* w, FILE* text_stream) {
+  void* cur_end_buffer = md->end_buf[rank].first;
+  while (cur_end_buffer < md->end_buf[rank].last) {
+    void* begin_ptr = MLOG_READ_ARG(&cur_end_buffer, void*);
+    if (begin_ptr) {
+      mlog_decoder_t decoder = MLOG_READ_ARG(&cur_end_buffer, mlog_decoder_t);
+      int            rank0   = _mlog_get_rank_from_begin_ptr(md, begin_ptr);
+      int            rank1   = rank;
+      if (decoder == MLOG_DECODER_TL) {
+        if (w->num_records == w->records_capacity) {
+          w->records_capacity = w->records_capacity ? w->records_capacity * 2 : 1024;
+          w->records = (mlog_binary_record_t*)_mlog_binary_realloc(
+              w->records, w->records_capacity * sizeof(mlog_binary_record_t));
+        }
+        mlog_binary_record_t* r = &w->records[w->num_records++];
+        r->rank0 = rank0;
+        r->rank1 = rank1;
+        r->t0    = MLOG_READ_ARG(&begin_ptr, uint64_t);
+        r->t1    = MLOG_READ_ARG(&cur_end_buffer, uint64_t);
+        r->kind  = _mlog_binary_kind_id(w, MLOG_READ_ARG(&cur_end_buffer, char*));
+      } else {
+        cur_end_buffer = decoder(text_stream, rank0, rank1, begin_ptr, cur_end_buffer);
+      }
+    } else {
+      char* format = MLOG_READ_ARG(&cur_end_buffer, char*);
+      cur_end_buffer = mlog_decode_printf(text_stream, format, cur_end_buffer);
+    }
+  }
+  mlog_clear_end_buffer(md, rank);
+}
+
+static inline void _mlog_binary_write(mlog_binary_writer_t* w, FILE* stream) {
+  static const char padding[8] = {0};
+  mlog_binary_header_t header;
+  memcpy(header.magic, MLOG_BINARY_MAGIC, sizeof(header.magic));
+  header.num_kinds   = w->num_kinds;
+  header.num_records = w->num_records;
+  fwrite(&header, sizeof(header), 1, stream);
+  for (size_t i = 0; i < w->num_kinds; i++) {
+    uint64_t len = strlen(w->kinds[i]);
+    fwrite(&len, sizeof(len), 1, stream);
+    fwrite(w->kinds[i], 1, len, stream);
+    fwrite(padding, 1, (8 - len % 8) % 8, stream);
+  }
+  fwrite(w->records, sizeof(mlog_binary_record_t), w->num_records, stream);
+  fflush(stream);
+}
+
+static inline void mlog_flush_binary(mlog_data_t* md, int rank, FILE* stream, FILE* text_stream) {
+  mlog_binary_writer_t w;
+  _mlog_binary_writer_init(&w);
+  _mlog_binary_collect(md, rank, &w, text_stream);
+  _mlog_binary_write(&w, stream);
+  _mlog_binary_writer_destroy(&w);
+  fflush(text_stream);
+}
+
+static inline void mlog_flush_binary_all(mlog_data_t* md, FILE* stream, FILE* text_stream) {
+  mlog_binary_writer_t w;
+  _mlog_binary_writer_init(&w);
+  for (int rank = 0; rank < md->num_ranks; rank++) {
+    _mlog_binary_collect(md, rank, &w, text_stream);
+  }
+  _mlog_binary_write(&w, stream);
+  _mlog_binary_writer_destroy(&w);
+  fflush(text_stream);
+  mlog_clear_begin_buffer_all(md);
 }
 
 #ifdef __cplusplus
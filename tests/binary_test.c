@@ -0,0 +1,82 @@
+#include "test_helper.h"
+
+#include "mlog/mlog.h"
+#include <string.h>
+
+mlog_data_t g_md;
+
+int main() {
+  mlog_init(&g_md, 3, 1024);
+
+  char*  buf           = NULL;
+  size_t buf_size      = 0;
+  char*  text_buf      = NULL;
+  size_t text_buf_size = 0;
+
+  FILE* stream = open_memstream(&buf, &buf_size);
+  ASSERT(stream != NULL, "Open Stream");
+
+  FILE* text_stream = open_memstream(&text_buf, &text_buf_size);
+  ASSERT(text_stream != NULL, "Open Stream");
+
+  int rank0[] = {0, 1, 2, 0, 2};
+  int rank1[] = {0, 1, 0, 1, 2};
+  const char* e0      = "event 0";
+  const char* e1      = "event 1";
+  const char* e2      = "long event name";
+  const char* kinds[] = {e0, e1, e0, e2, e1};
+
+  void* x0 = mlog_begin_tl(&g_md, rank0[0]); // event 0
+  mlog_end_tl(&g_md, rank1[0], x0, kinds[0]);
+  void* x1 = mlog_begin_tl(&g_md, rank0[1]); // event 1
+  void* x2 = mlog_begin_tl(&g_md, rank0[2]); // event 2
+  void* x3 = mlog_begin_tl(&g_md, rank0[3]); // event 3
+  mlog_end_tl(&g_md, rank1[3], x3, kinds[3]);
+  MLOG_PRINTF(&g_md, 1, "printf %d\n", 42);
+  mlog_end_tl(&g_md, rank1[2], x2, kinds[2]);
+  void* x4 = mlog_begin_tl(&g_md, rank0[4]); // event 4
+  mlog_end_tl(&g_md, rank1[1], x1, kinds[1]);
+  mlog_end_tl(&g_md, rank1[4], x4, kinds[4]);
+
+  mlog_flush_binary_all(&g_md, stream, text_stream);
+
+  // assert
+  ASSERT(!strcmp(text_buf, "printf 42\n"), "text: %s\n", text_buf);
+
+  char* p = buf;
+  mlog_binary_header_t header;
+  memcpy(&header, p, sizeof(header));
+  p += sizeof(header);
+  ASSERT(!strncmp(header.magic, MLOG_BINARY_MAGIC, sizeof(header.magic)), "invalid magic\n");
+  ASSERT(header.num_kinds == 3, "# of kinds: %ld\nexpected: %d\n", header.num_kinds, 3);
+  ASSERT(header.num_records == 5, "# of records: %ld\nexpected: %d\n", header.num_records, 5);
+
+  char kind_names[3][32];
+  for (int k = 0; k < 3; k++) {
+    uint64_t len;
+    memcpy(&len, p, sizeof(len));
+    p += sizeof(len);
+    ASSERT(len < sizeof(kind_names[k]), "kind length: %ld\n", len);
+    memcpy(kind_names[k], p, len);
+    kind_names[k][len] = '\0';
+    p += (len + 7) / 8 * 8;
+  }
+
+  int expected_order[] = {0, 2, 3, 1, 4};
+  for (int i = 0; i < 5; i++) {
+    mlog_binary_record_t r;
+    memcpy(&r, p, sizeof(r));
+    p += sizeof(r);
+    int e = expected_order[i];
+    ASSERT(r.rank0 == rank0[e], "rank0: %d\nexpected: %d\n", r.rank0, rank0[e]);
+    ASSERT(r.rank1 == rank1[e], "rank1: %d\nexpected: %d\n", r.rank1, rank1[e]);
+    ASSERT(r.t0 <= r.t1, "t0 (%ld) > t1 (%ld)\n", r.t0, r.t1);
+    ASSERT(r.kind < 3, "kind: %ld\n", r.kind);
+    ASSERT(!strcmp(kind_names[r.kind], kinds[e]), "kind: %s\nexpected: %s\n", kind_names[r.kind], kinds[e]);
+  }
+  ASSERT(p == buf + buf_size, "trailing bytes: %ld\n", (long)(buf + buf_size - p));
+
+  return 0;
+}
+
+/* vim: set ts=2 sw=2 tw=0: */
@@ -0,0 +1,206 @@
+import concurrent.futures
+import os
+import queue
+import sys
+
+import pandas
+import pytest
+import bokeh.models
+from bokeh.application import Application
+from bokeh.application.handlers import DirectoryHandler
+
+from timeline_trace_test import KINDS, make_events, write_csv
+
+VIEWER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'viewer')
+
+def private(viewer, name):
+    return getattr(viewer, '_TimelineTraceViewer__' + name)
+
+def refresh(viewer):
+    """Runs the timer until the plots show the newest state, as the server would."""
+    requests = private(viewer, 'refresh_requests')
+    refreshed = private(viewer, 'refreshed_requests')
+    running = private(viewer, 'running_queries')
+    while requests != refreshed or running:
+        private(viewer, 'on_timer')()
+        for _ in range(len(running)):
+            viewer.next_tick_callbacks.get(timeout=60)()
+
+@pytest.fixture(scope='module')
+def trace_path(tmp_path_factory):
+    return write_csv(make_events(20000), tmp_path_factory.mktemp('viewer') / 'trace.csv')
+
+@pytest.fixture
+def viewer(trace_path):
+    doc = Application(DirectoryHandler(filename=VIEWER_DIR, argv=[trace_path])) \
+        .create_document()
+    viewer = next(iter(doc.session_destroyed_callbacks)).__self__
+    # callbacks to the event loop are run by `refresh`
+    viewer.next_tick_callbacks = queue.Queue()
+    doc.add_next_tick_callback = viewer.next_tick_callbacks.put
+    yield viewer
+    private(viewer, 'on_session_destroyed')(None)
+
+def visible_rows(src):
+    """Rows shown by `src`; slots of rows that left have no position."""
+    df = pandas.DataFrame(src.data).drop(columns='index')
+    return df[df['rank0_pos'].notna()]
+
+def sorted_rows(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+def test_update_source_sends_changed_rows(viewer, monkeypatch):
+    trace = private(viewer, 'trace')
+    kinds = set(trace.get_kinds())
+    src = bokeh.models.ColumnDataSource()
+    patch = bokeh.models.ColumnDataSource.patch
+    patched = []
+    monkeypatch.setattr(bokeh.models.ColumnDataSource, 'patch',
+                        lambda self, patches: (patched.append(patches), patch(self, patches)))
+    # panning keeps most rows, and zooming out adds rows
+    for start, end in ((30000, 40000), (31000, 41000), (33000, 43000), (20000, 60000),
+                       (30000, 40000)):
+        sl, _ = trace.get_sampled_time_slice((start, end), kinds, 1000)
+        sl.add_rank_pos(30)
+        df = sl.dataframe().reset_index(drop=True)
+        private(viewer, 'update_source')(src, df)
+        pandas.testing.assert_frame_equal(sorted_rows(visible_rows(src)), sorted_rows(df),
+                                          check_dtype=False)
+    assert patched
+
+def test_lru_cache_evicts_least_recently_used(viewer):
+    cache = sys.modules[type(viewer).__module__].LruCache(100)
+    for key in 'abc':
+        cache.put(key, key.upper(), 30)
+    assert cache.get('a') == 'A'
+    # 'b' is the least recently used
+    cache.put('d', 'D', 30)
+    assert cache.get('b') is None
+    assert [cache.get(key) for key in 'acd'] == ['A', 'C', 'D']
+    assert cache.find(lambda key, value: key in 'ab') == 'A'
+    cache.put('e', 'E', 30)
+    assert cache.get('c') is None and cache.get('a') == 'A'
+    # values larger than the cache are not cached, and replace older values
+    cache.put('a', 'AA', 101)
+    assert cache.get('a') is None and cache.get('e') == 'E'
+
+def test_query_uses_the_state_it_was_submitted_with(viewer, monkeypatch):
+    trace = private(viewer, 'trace')
+    state = private(viewer, 'get_query_state')()
+    get_sampled_time_slice = trace.get_sampled_time_slice
+
+    def change_state_while_querying(*args, **kwargs):
+        private(viewer, 'on_change_slider')('max_lanes', 'value', state.max_lanes, 1)
+        private(viewer, 'on_click_kind_checkboxes')([0])
+        return get_sampled_time_slice(*args, **kwargs)
+
+    monkeypatch.setattr(trace, 'get_sampled_time_slice', change_state_while_querying)
+    time_range = (30000, 40000)
+    sl, num_total = private(viewer, 'get_sampled_time_slice')(state, time_range)
+    monkeypatch.undo()
+    expected, expected_total = trace.get_sampled_time_slice(
+        time_range, set(KINDS), state.num_samples, state.num_pixels, state.rank_range)
+    expected.add_rank_pos(state.max_lanes)
+    assert num_total == expected_total
+    pandas.testing.assert_frame_equal(sl.dataframe(), expected.dataframe())
+    # the slice is cached for the state of the query
+    cached, _ = private(viewer, 'get_sampled_time_slice')(state, time_range)
+    assert cached is sl
+
+def test_refresh_shows_the_newest_state(viewer):
+    bar_src = private(viewer, 'main_tabs')[0].bar_src
+    x_range = private(viewer, 'main_tabs')[0].fig.x_range
+    x_range.update(start=30000, end=40000)
+    private(viewer, 'on_timer')()
+    # the state changes while the window is queried, which drops its result
+    private(viewer, 'on_change_slider')('max_lanes', 'value', 30, 1)
+    private(viewer, 'on_click_kind_checkboxes')([0, 2])
+    refresh(viewer)
+    df = pandas.DataFrame(bar_src.data)
+    # hidden slots of left rows have no position
+    df = df[df['rank0_pos'].notna()]
+    assert len(df) > 0
+    assert set(df['kind']) <= {KINDS[0], KINDS[2]}
+    assert (df['t1'] >= 30000).all() and (df['t0'] <= 40000).all()
+    assert (df['height'] == 1).all()
+
+def test_stale_results_are_dropped(viewer, capsys):
+    bar_src = private(viewer, 'main_tabs')[0].bar_src
+    x_range = private(viewer, 'main_tabs')[0].fig.x_range
+    x_range.update(start=30000, end=40000)
+    private(viewer, 'on_timer')()
+    assert 'main' in private(viewer, 'running_queries')
+    # the user pans before the result reaches the event loop
+    x_range.update(start=50000, end=60000)
+    refresh(viewer)
+    assert "Dropped a stale main plot." in capsys.readouterr().out
+    df = visible_rows(bar_src)
+    assert len(df) > 0
+    assert (df['t1'] >= 50000).all() and (df['t0'] <= 60000).all()
+
+@pytest.mark.parametrize('reduction_mode, num_samples', [(1, 10000), (0, 10000), (0, 100)])
+def test_pans_are_cut_out_of_prefetched_windows(viewer, monkeypatch, reduction_mode,
+                                                num_samples):
+    trace = private(viewer, 'trace')
+    bar_src = private(viewer, 'main_tabs')[0].bar_src
+    x_range = private(viewer, 'main_tabs')[0].fig.x_range
+    private(viewer, 'on_change_reduction_mode')('active', 0, reduction_mode)
+    private(viewer, 'on_change_slider')('num_main_bar_samples', 'value', 10000, num_samples)
+    x_range.update(start=30000, end=40000)
+    refresh(viewer)
+    concurrent.futures.wait(private(viewer, 'prefetch_futures'))
+
+    get_sampled_time_slice = trace.get_sampled_time_slice
+    queried = []
+    monkeypatch.setattr(trace, 'get_sampled_time_slice',
+                        lambda *args: (queried.append(args), get_sampled_time_slice(*args))[1])
+    x_range.update(start=33000, end=43000)
+    refresh(viewer)
+    assert queried == []
+    df = visible_rows(bar_src)
+    assert (df['t1'] >= 33000).all() and (df['t0'] <= 43000).all()
+    if num_samples == 100:
+        assert private(viewer, 'main_bucket_width') is not None
+    else:
+        expected, _ = get_sampled_time_slice((33000, 43000), set(KINDS), num_samples)
+        assert sorted(df['line']) == sorted(expected.dataframe()['line'])
+
+def test_overview_is_cached_per_visible_kinds(viewer, monkeypatch):
+    trace = private(viewer, 'trace')
+    get_time_raster = trace.get_time_raster
+    rasters = []
+    monkeypatch.setattr(trace, 'get_time_raster',
+                        lambda *args: (rasters.append(args), get_time_raster(*args))[1])
+    get_rangetool_data = private(viewer, 'get_rangetool_data')
+    # the overview of all kinds was made on opening the viewer
+    state = private(viewer, 'get_query_state')()
+    data = get_rangetool_data(state)
+    rank_min, rank_max = trace.get_rank_range()
+    assert data['image'][0].shape == (rank_max - rank_min + 1, state.rt_num_pixels)
+    # panning and sliders do not change the overview
+    private(viewer, 'main_tabs')[0].fig.x_range.update(start=30000, end=40000)
+    private(viewer, 'on_change_slider')('max_lanes', 'value', 30, 1)
+    assert get_rangetool_data(private(viewer, 'get_query_state')()) is data
+    private(viewer, 'on_click_kind_checkboxes')([0])
+    assert get_rangetool_data(private(viewer, 'get_query_state')()) is not data
+    assert [args[1] for args in rasters] == [frozenset(KINDS[:1])]
+
+def test_preview_is_shown_before_slow_slices(viewer, monkeypatch):
+    trace = private(viewer, 'trace')
+    private(viewer, 'on_change_slider')('num_main_bar_samples', 'value', 10000, 100)
+    private(viewer, 'main_tabs')[0].fig.x_range.update(start=0, end=110000)
+    state = private(viewer, 'get_query_state')()
+    preview, num_total = private(viewer, 'get_preview_time_slice')(state, state.time_range)
+    assert num_total == trace.count_events(state.time_range, set(KINDS), state.rank_range)
+    assert preview.bucket_width() is not None and 0 < preview.size() <= state.num_samples
+    # the exact slice is shown next, and then is cached
+    private(viewer, 'get_sampled_time_slice')(state, state.time_range)
+    assert private(viewer, 'get_preview_time_slice')(state, state.time_range) is None
+
+    update_main_data = private(viewer, 'update_main_data')
+    shown = []
+    monkeypatch.setattr(viewer, '_TimelineTraceViewer__update_main_data',
+                        lambda data: (shown.append(data), update_main_data(data)))
+    private(viewer, 'main_tabs')[0].fig.x_range.update(start=10000, end=100000)
+    refresh(viewer)
+    assert len(shown) == 2
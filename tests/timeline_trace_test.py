@@ -0,0 +1,420 @@
+import gzip
+import json
+import lzma
+import math
+import os
+import sys
+
+import numpy
+import pandas
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'viewer'))
+import timeline_trace
+from timeline_trace import TimelineTrace
+
+NUM_RANKS = 6
+KINDS = ['k0', 'k1', 'k2', 'k3']
+ALL_EVENTS = 10 ** 9
+
+def make_events(num_events, seed=0):
+    """Returns random events of nested calls and of overlapping messages."""
+    rng = numpy.random.default_rng(seed)
+    rank0 = rng.integers(0, NUM_RANKS, num_events)
+    t0 = rng.integers(0, 100000, num_events)
+    duration = numpy.where(rng.random(num_events) < 0.1,
+                           rng.integers(0, 20000, num_events), rng.integers(0, 300, num_events))
+    rank1 = numpy.where(rng.random(num_events) < 0.2,
+                        rng.integers(0, NUM_RANKS, num_events), rank0)
+    kind = rng.choice(KINDS, num_events)
+    return pandas.DataFrame({'rank0': rank0, 't0': t0, 'rank1': rank1, 't1': t0 + duration,
+                             'kind': kind}, columns=TimelineTrace.COLUMNS)
+
+def write_csv(df, path):
+    df.to_csv(path, header=False, index=False)
+    return str(path)
+
+def read_trace(path):
+    return TimelineTrace().read(path)
+
+def overlapping(df, time_range, kinds, rank_range=None):
+    """Reference of events overlapping a window, with line numbers as the index.
+    Ranks out of the trace are clipped, keeping at least one rank."""
+    start, end = math.ceil(time_range[0]), math.floor(time_range[1])
+    mask = (df['t0'] <= end) & (df['t1'] >= start) & df['kind'].isin(kinds)
+    if rank_range is not None:
+        rank_min, rank_max = df['rank0'].min(), df['rank0'].max()
+        lo = min(max(rank_range[0], rank_min), rank_max)
+        mask &= df['rank0'].between(lo, max(min(rank_range[1], rank_max), lo))
+    return df[mask]
+
+def splitmix(x):
+    mask = (1 << 64) - 1
+    x = (x + 0x9E3779B97F4A7C15) & mask
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & mask
+    return x ^ (x >> 31)
+
+def greedy_lanes(rank, t0, t1):
+    """Reference of `assign_lanes`: the lowest lane whose last event has ended."""
+    lanes = numpy.zeros(len(t0), dtype=numpy.int64)
+    for r in numpy.unique(rank):
+        events = sorted((i for i in range(len(t0)) if rank[i] == r and t0[i] < t1[i]),
+                        key=lambda i: (t0[i], -t1[i], i))
+        lane_ends = []
+        for i in events:
+            lane = next((l for l, e in enumerate(lane_ends) if e <= t0[i]), len(lane_ends))
+            if lane == len(lane_ends):
+                lane_ends.append(t1[i])
+            else:
+                lane_ends[lane] = t1[i]
+            lanes[i] = lane
+    return lanes
+
+def random_windows(seed, num_windows=30):
+    rng = numpy.random.default_rng(seed)
+    for _ in range(num_windows):
+        start = rng.uniform(-1000, 110000)
+        width = 10 ** rng.uniform(0, 5.2)
+        kinds = set(KINDS) if rng.random() < 0.5 else \
+            set(rng.choice(KINDS, rng.integers(1, len(KINDS)), replace=False))
+        rank_range = None if rng.random() < 0.5 else \
+            tuple(int(r) for r in numpy.sort(rng.integers(-1, NUM_RANKS + 1, 2)))
+        yield (start, start + width), kinds, rank_range
+
+def assert_same_trace(a, b):
+    assert a.get_time_range() == b.get_time_range()
+    assert a.get_rank_range() == b.get_rank_range()
+    assert a.get_kinds() == b.get_kinds()
+    assert numpy.array_equal(a.get_rank_lanes(), b.get_rank_lanes())
+    kinds = set(a.get_kinds())
+    time_range = a.get_time_range()
+    for num_samples, num_pixels in ((ALL_EVENTS, None), (100, None), (100, 500)):
+        sa, na = a.get_sampled_time_slice(time_range, kinds, num_samples, num_pixels)
+        sb, nb = b.get_sampled_time_slice(time_range, kinds, num_samples, num_pixels)
+        assert na == nb
+        pandas.testing.assert_frame_equal(sa.dataframe(), sb.dataframe())
+    ra, _, _ = a.get_time_raster(time_range, kinds, 300)
+    rb, _, _ = b.get_time_raster(time_range, kinds, 300)
+    assert numpy.array_equal(ra, rb)
+
+@pytest.fixture(scope='module')
+def events():
+    return make_events(20000)
+
+@pytest.fixture(scope='module')
+def trace(events, tmp_path_factory):
+    return read_trace(write_csv(events, tmp_path_factory.mktemp('trace') / 'trace.csv'))
+
+def test_line_priority_is_splitmix64():
+    lines = numpy.array([0, 1, 2, 12345, 1 << 40])
+    assert timeline_trace.line_priority(lines).tolist() == [splitmix(int(x)) for x in lines]
+
+def test_priority_level_is_number_of_leading_zeros():
+    priority = numpy.array([0, 1, (1 << 32) - 1, 1 << 32, (1 << 33) - 1, (1 << 63) - 1, 1 << 63,
+                            (1 << 64) - 1], dtype=numpy.uint64)
+    expected = [min(32, 64 - int(p).bit_length()) for p in priority]
+    assert timeline_trace.priority_level(priority).tolist() == expected
+
+def test_count_not_greater():
+    rng = numpy.random.default_rng(1)
+    keys = [rng.integers(0, 5, 200), rng.integers(0, 5, 200)]
+    values = [rng.integers(-1, 6, 100), rng.integers(-1, 6, 100)]
+    expected = [sum((k0, k1) <= (v0, v1) for k0, k1 in zip(*keys))
+                for v0, v1 in zip(*values)]
+    assert timeline_trace.count_not_greater(keys, values).tolist() == expected
+
+def test_radix_argsort_is_stable():
+    rng = numpy.random.default_rng(2)
+    for max_key in (1, 300, 1 << 20, 1 << 40):
+        keys = rng.integers(0, max_key, 5000)
+        assert numpy.array_equal(timeline_trace.radix_argsort(keys),
+                                 numpy.argsort(keys, kind='stable'))
+
+@pytest.mark.parametrize('seed', range(6))
+def test_assign_lanes_matches_greedy(seed):
+    rng = numpy.random.default_rng(seed)
+    num_events = 400
+    rank = rng.integers(0, 3, num_events)
+    if seed % 3 == 0:
+        # properly nested calls take the fast path
+        t0 = numpy.sort(rng.integers(0, 1000, num_events))
+        t1 = t0 + numpy.where(numpy.arange(num_events) % 5 == 0, 1000 - t0, 0)
+    elif seed % 3 == 1:
+        t0 = rng.integers(0, 1000, num_events)
+        t1 = t0 + rng.integers(0, 100, num_events)
+    else:
+        # a few messages cross nested calls, which are assigned greedily around them
+        t0 = rng.integers(0, 100, num_events) * 10
+        t1 = t0 + numpy.where(rng.random(num_events) < 0.05, rng.integers(1, 50, num_events),
+                              rng.integers(0, 3, num_events))
+    assert numpy.array_equal(timeline_trace.assign_lanes(rank, t0, t1),
+                             greedy_lanes(rank, t0, t1))
+
+def test_lanes_of_store_match_greedy(events, trace):
+    df = trace.get_sampled_time_slice(trace.get_time_range(), set(KINDS), ALL_EVENTS)[0] \
+        .dataframe().sort_values('line')
+    expected = greedy_lanes(events['rank0'].values, events['t0'].values, events['t1'].values)
+    assert numpy.array_equal(df['lane'].values, expected)
+    assert numpy.array_equal(trace.get_rank_lanes(),
+                             [expected[events['rank0'].values == r].max() + 1
+                              for r in range(NUM_RANKS)])
+
+def test_exact_overlap(events, trace):
+    for time_range, kinds, rank_range in random_windows(3):
+        sl, num_total = trace.get_sampled_time_slice(time_range, kinds, ALL_EVENTS,
+                                                     rank_range=rank_range)
+        expected = overlapping(events, time_range, kinds, rank_range)
+        assert num_total == len(expected)
+        assert trace.count_events(time_range, kinds, rank_range) == len(expected)
+        df = sl.dataframe().sort_values('line')
+        assert df['line'].tolist() == expected.index.tolist()
+        for name in TimelineTrace.COLUMNS:
+            assert df[name].tolist() == expected[name].tolist()
+
+@pytest.mark.parametrize('num_samples', [1, 10, 300])
+def test_sampling_takes_lowest_priorities(events, trace, num_samples):
+    for time_range, kinds, rank_range in random_windows(num_samples):
+        sl, num_total = trace.get_sampled_time_slice(time_range, kinds, num_samples,
+                                                     rank_range=rank_range)
+        lines = overlapping(events, time_range, kinds, rank_range).index
+        assert num_total == len(lines)
+        assert sorted(sl.dataframe()['line']) == sorted(sorted(lines, key=splitmix)[:num_samples])
+
+def pixel_cover(df, time_range, num_pixels):
+    """Pixels of (rank, lane) covered by events or runs in the window."""
+    start, end = math.ceil(time_range[0]), math.floor(time_range[1])
+    pixel_width = max(1, end - start) / num_pixels
+    cover = set()
+    for rank, lane, t0, t1 in zip(df['rank0'], df['lane'], df['t0'], df['t1']):
+        p0 = int(min((max(t0, start) - start) // pixel_width, num_pixels - 1))
+        p1 = int(min((min(t1, end) - start) // pixel_width, num_pixels - 1))
+        cover.update((rank, lane, p) for p in range(p0, p1 + 1))
+    return cover
+
+def test_decimated_slice_covers_events_in_lanes(trace):
+    num_pixels = 400
+    for time_range in ((0, 120000), (30000, 40000)):
+        sl, num_total = trace.get_sampled_time_slice(time_range, set(KINDS), 100, num_pixels)
+        events, _ = trace.get_sampled_time_slice(time_range, set(KINDS), ALL_EVENTS)
+        df = sl.dataframe()
+        assert num_total > 100 and sl.bucket_width() is not None and sl.in_lanes()
+        assert (df['lane'] < df['num_lanes']).all()
+        assert len(df) <= trace.get_rank_lanes().sum() * num_pixels
+        assert pixel_cover(df, time_range, num_pixels) == \
+            pixel_cover(events.dataframe(), time_range, num_pixels)
+
+def test_lod_slice_is_bounded_by_pixels(trace, monkeypatch):
+    monkeypatch.setattr(TimelineTrace, 'DECIMATION_MAX_EVENTS', 0)
+    num_pixels = 200
+    for time_range in ((0, 120000), (30000, 30100)):
+        sl, num_total = trace.get_sampled_time_slice(time_range, set(KINDS), 1, num_pixels)
+        assert sl.bucket_width() is not None and not sl.in_lanes()
+        assert 0 < sl.size() <= NUM_RANKS * num_pixels
+        assert num_total == trace.count_events(time_range, set(KINDS))
+
+def test_lod_reaches_the_last_bucket(tmp_path, monkeypatch):
+    # Windows ending at the last bucket of a rank used to miss the entries of every
+    # other rank. Pixels are wider than buckets, so that each pixel has some.
+    rng = numpy.random.default_rng(4)
+    num_events = 8192
+    t0 = rng.integers(0, 1024, num_events)
+    df = pandas.DataFrame({'rank0': rng.integers(0, 2, num_events), 't0': t0, 'rank1': 0,
+                           't1': numpy.minimum(t0 + rng.integers(0, 3, num_events), 1023),
+                           'kind': rng.choice(KINDS[:3], num_events)},
+                          columns=TimelineTrace.COLUMNS)
+    df.loc[0, ['rank0', 't0', 't1']] = (1, 0, 1023)
+    df.loc[1, ['rank0', 't0', 't1']] = (0, 0, 1023)
+    df['rank1'] = df['rank0']
+    trace = read_trace(write_csv(df, tmp_path / 'lod.csv'))
+    monkeypatch.setattr(TimelineTrace, 'DECIMATION_MAX_EVENTS', 0)
+    for time_range in ((0, 1023), (0, 900)):
+        raster, num_total, _ = trace.get_time_raster(time_range, set(KINDS), 500)
+        assert num_total == len(overlapping(df, time_range, KINDS))
+        assert (raster >= 0).all()
+        sl, _ = trace.get_sampled_time_slice(time_range, set(KINDS), 0, 500)
+        assert sorted(sl.dataframe()['rank0'].unique()) == [0, 1]
+
+def test_empty_kinds_are_kinds(tmp_path):
+    path = tmp_path / 'kinds.csv'
+    path.write_text('0,10,0,20,a\n0,30,0,40,\n1,50,1,60,NA\n1,70,1,80\n')
+    trace = read_trace(str(path))
+    assert trace.get_kinds() == ['', 'NA', 'a']
+    sl, num_total = trace.get_sampled_time_slice(trace.get_time_range(), {''}, ALL_EVENTS)
+    assert num_total == 2
+    assert sl.dataframe().sort_values('line')['t0'].tolist() == [30, 70]
+
+def store_arrays(path):
+    store_dir = path + TimelineTrace.STORE_SUFFIX
+    with open(os.path.join(store_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    del meta['key']
+    return meta, {name: numpy.load(os.path.join(store_dir, name))
+                  for name in sorted(os.listdir(store_dir)) if name.endswith('.npy')}
+
+@pytest.mark.parametrize('num_workers', [1, 3])
+@pytest.mark.parametrize('budget', [1 << 16, 1 << 20])
+def test_store_does_not_depend_on_memory_budget(events, trace, tmp_path, monkeypatch, budget,
+                                                num_workers):
+    default_path = write_csv(events, tmp_path / 'default.csv')
+    read_trace(default_path)
+    monkeypatch.setattr(TimelineTrace, 'MEMORY_BUDGET', budget)
+    # runs, lanes and the level of detail are made in threads
+    monkeypatch.setattr(TimelineTrace, 'NUM_READ_WORKERS', num_workers)
+    small_path = write_csv(events, tmp_path / 'small.csv')
+    small = read_trace(small_path)
+    meta, arrays = store_arrays(default_path)
+    small_meta, small_arrays = store_arrays(small_path)
+    assert meta == small_meta
+    assert arrays.keys() == small_arrays.keys()
+    for name, values in arrays.items():
+        assert values.dtype == small_arrays[name].dtype, name
+        assert numpy.array_equal(values, small_arrays[name]), name
+    assert_same_trace(trace, small)
+
+def test_store_of_events_in_time_order_per_rank(events, trace, tmp_path):
+    # ranks interleaved in order of time take the partition by rank
+    df = events.iloc[numpy.argsort(events['t0'].values, kind='stable')]
+    sorted_trace = read_trace(write_csv(df, tmp_path / 'sorted.csv'))
+    sl, _ = sorted_trace.get_sampled_time_slice(sorted_trace.get_time_range(), set(KINDS),
+                                                ALL_EVENTS)
+    df = df.reset_index(drop=True)
+    got = sl.dataframe().sort_values('line')
+    for name in TimelineTrace.COLUMNS:
+        assert got[name].tolist() == df[name].tolist()
+
+def test_multiple_files_are_one_trace(events, trace, tmp_path):
+    paths = []
+    for i, part in enumerate(numpy.array_split(events, 3)):
+        paths.append(write_csv(part, tmp_path / 'part-{}.csv'.format(i)))
+    merged = TimelineTrace()
+    merged.read_files([str(tmp_path / 'part-*.csv')])
+    assert_same_trace(trace, merged)
+
+def test_rank_offsets_of_files(events, tmp_path):
+    rank_min = events['rank0'].min()
+    paths = []
+    for i, part in enumerate(numpy.array_split(events, 3)):
+        part = part.assign(rank0=part['rank0'] - rank_min, rank1=part['rank1'] - rank_min)
+        paths.append(write_csv(part, tmp_path / 'rank-{}.csv'.format(i)))
+    merged = TimelineTrace()
+    merged.read_files(paths, [0, 100, 200])
+    sl, _ = merged.get_sampled_time_slice(merged.get_time_range(), set(KINDS), ALL_EVENTS)
+    offsets = numpy.repeat([0, 100, 200], [len(p) for p in numpy.array_split(events, 3)])
+    got = sl.dataframe().sort_values('line')
+    assert got['rank0'].tolist() == (events['rank0'].values - rank_min + offsets).tolist()
+    assert got['rank1'].tolist() == (events['rank1'].values - rank_min + offsets).tolist()
+
+@pytest.mark.parametrize('compression', ['gzip', 'xz', 'zstd'])
+def test_compressed_trace(events, trace, tmp_path, compression):
+    data = events.to_csv(header=False, index=False).encode()
+    path = str(tmp_path / 'trace.csv.{}'.format(compression))
+    if compression == 'gzip':
+        data = gzip.compress(data)
+    elif compression == 'xz':
+        data = lzma.compress(data)
+    else:
+        data = pytest.importorskip('zstandard').ZstdCompressor().compress(data)
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert timeline_trace.get_compression(path) == compression
+    assert_same_trace(trace, read_trace(path))
+
+def binary_blocks(df, num_blocks):
+    """Returns `df` in blocks of the binary format written by `mlog_flush_binary`."""
+    blocks = []
+    for part in numpy.array_split(df, num_blocks):
+        kinds = sorted(set(part['kind']))
+        header = numpy.array([(TimelineTrace.BINARY_MAGIC, len(kinds), len(part))],
+                             dtype=TimelineTrace.BINARY_HEADER_DTYPE)
+        data = [header.tobytes()]
+        for kind in kinds:
+            name = kind.encode()
+            data.append(numpy.array([len(name)], dtype='<u8').tobytes())
+            data.append(name.ljust((len(name) + 7) // 8 * 8, b'\0'))
+        records = numpy.empty(len(part), dtype=TimelineTrace.BINARY_RECORD_DTYPE)
+        for name in ('rank0', 't0', 'rank1', 't1'):
+            records[name] = part[name].values
+        records['kind'] = numpy.searchsorted(kinds, part['kind'].values)
+        data.append(records.tobytes())
+        blocks.append(b''.join(data))
+    return blocks
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'xz'])
+def test_binary_trace(events, trace, tmp_path, compression):
+    data = b''.join(binary_blocks(events, 3))
+    path = str(tmp_path / 'trace.bin')
+    if compression == 'gzip':
+        data = gzip.compress(data)
+    elif compression == 'xz':
+        data = lzma.compress(data)
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert_same_trace(trace, read_trace(path))
+
+def test_followed_binary_trace(events, trace, tmp_path):
+    blocks = binary_blocks(events, 4)
+    path = str(tmp_path / 'followed.bin')
+    with open(path, 'wb') as f:
+        f.write(blocks[0])
+    followed = timeline_trace.FollowedTimelineTrace(path)
+    for block in blocks[1:]:
+        with open(path, 'ab') as f:
+            # a block being written is read once it is complete
+            f.write(block[:len(block) // 2])
+            f.flush()
+            followed.update()
+            f.write(block[len(block) // 2:])
+        followed.update()
+    assert followed.get_time_range() == trace.get_time_range()
+    assert followed.get_kinds() == trace.get_kinds()
+    time_range = trace.get_time_range()
+    got, got_total = followed.get_sampled_time_slice(time_range, set(KINDS), ALL_EVENTS)
+    expected, total = trace.get_sampled_time_slice(time_range, set(KINDS), ALL_EVENTS)
+    assert got_total == total
+    assert sorted(got.dataframe()['line']) == sorted(expected.dataframe()['line'])
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_csv_is_parsed_in_worker_processes(tmp_path, monkeypatch, compression):
+    # a few chunks of at least 1 MB each
+    df = make_events(150000, seed=5)
+    data = df.to_csv(header=False, index=False).encode()
+    if compression == 'gzip':
+        data = gzip.compress(data)
+    paths = []
+    for name in ('serial', 'parallel'):
+        paths.append(str(tmp_path / '{}.csv{}'.format(name, '.gz' if compression else '')))
+        with open(paths[-1], 'wb') as f:
+            f.write(data)
+    monkeypatch.setattr(TimelineTrace, 'CSV_CHUNK_BYTES', 1 << 20)
+    monkeypatch.setattr(TimelineTrace, 'NUM_READ_WORKERS', 1)
+    serial = read_trace(paths[0])
+    monkeypatch.setattr(TimelineTrace, 'NUM_READ_WORKERS', 3)
+    parallel = read_trace(paths[1])
+    assert parallel.get_num_events() == len(df)
+    assert_same_trace(serial, parallel)
+    _, arrays = store_arrays(paths[0])
+    _, parallel_arrays = store_arrays(paths[1])
+    for name, values in arrays.items():
+        assert numpy.array_equal(values, parallel_arrays[name]), name
+
+def test_followed_trace_reads_appended_events(events, trace, tmp_path):
+    data = events.to_csv(header=False, index=False).encode()
+    path = str(tmp_path / 'followed.csv')
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 5])
+    followed = timeline_trace.FollowedTimelineTrace(path)
+    for end in (len(data) // 3, len(data) // 3 + 7, len(data) // 2, len(data)):
+        with open(path, 'ab') as f:
+            f.write(data[os.path.getsize(path):end])
+        followed.update()
+    assert followed.get_time_range() == trace.get_time_range()
+    assert followed.get_rank_range() == trace.get_rank_range()
+    for time_range, kinds, rank_range in random_windows(5, 10):
+        for num_samples in (ALL_EVENTS, 10):
+            got, got_total = followed.get_sampled_time_slice(time_range, kinds, num_samples,
+                                                             rank_range=rank_range)
+            expected, total = trace.get_sampled_time_slice(time_range, kinds, num_samples,
+                                                           rank_range=rank_range)
+            assert got_total == total
+            assert sorted(got.dataframe()['line']) == sorted(expected.dataframe()['line'])
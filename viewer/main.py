@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
 # Run this script with this command:
-#   $ bokeh serve --show ./main.py --args "trace_file"
+#   $ bokeh serve --show ./viewer --args "trace_file" [more trace files...] [options]
 
+import os
 import sys
 import collections
-import random
+import threading
+import concurrent.futures
 import functools
 import traceback
 import math
@@ -19,122 +21,119 @@ import bokeh.models.tickers
 import bokeh.layouts
 import bokeh.palettes
 import bokeh.transform
-
-class TimelineTraceSlice:
-    def __init__(self, df):
-        self.__df = df
-        self.__df.reset_index(inplace=True, drop=True)
-
-    def get_sampled_slice(self, num_samples):
-        return TimelineTraceSlice(self.__df.sample(num_samples)
-                                  if self.size() > num_samples else self.__df)
-
-    def dataframe(self):
-        return self.__df
-
-    def size(self):
-        return len(self.__df.index)
-
-    def add_rank_pos(self, num_conc):
-        self.__df = self.__df.assign(
-            rank0_pos=self.__df.loc[:, 'rank0']+
-                      (numpy.mod(self.__df.index, num_conc)+0.5)/num_conc,
-            height=1/num_conc)
-        self.__df = self.__df.assign(
-            rank1_pos=numpy.where(self.__df.loc[:, 'rank0'] == self.__df.loc[:, 'rank1'],
-                                  self.__df.loc[:, 'rank0_pos'],
-                                  self.__df.loc[:, 'rank1']+0.5))
-
-class TimelineTrace:
-    def read_csv(self, input_path):
-        COLUMNS = ['rank0', 't0', 'rank1', 't1', 'kind']
-        print("Reading CSV...")
-        df = pandas.read_csv(input_path, names=COLUMNS)
-
-        print("Preparing data...")
-        df['duration'] = df['t1']-df['t0']
-        self.__columns = df.columns
-        self.__time_min = df['t0'].min()
-        self.__time_max = df['t1'].max()
-
-        df.sort_values('t0', inplace=True)
-        df.rename_axis('line', inplace=True)
-
-        self.__data = collections.OrderedDict((x for x in df.groupby('kind'))) # workaround
-        self.__t1_index = collections.OrderedDict()
-        for kind, kind_df in self.__data.items():
-            kind_df.reset_index(inplace=True)
-            self.__t1_index[kind] = kind_df['t1'].sort_values()
-
-        print("Trace is loaded.")
-        return self
-
-    def get_sampled_time_slice(self, time_range, kinds, num_samples):
-        print("Making slices...")
-        index_start = numpy.fromiter(
-            ((t1_ser.searchsorted(time_range[0]).item() if kind in kinds else 0)
-             for kind, t1_ser in self.__t1_index.items()), dtype=int)
-        index_end = numpy.fromiter(
-            ((kind_df['t0'].searchsorted(time_range[1], 'right').item() if kind in kinds else 0)
-             for kind, kind_df in self.__data.items()), dtype=int)
-
-        num_list = index_end - index_start
-        num_sum_right = num_list.cumsum()
-        num_total = num_sum_right[len(num_sum_right)-1] if num_sum_right.size > 0 else 0
-        num_sum_left = [(0 if i == 0 else num_sum_right[i-1]) for i in range(len(num_sum_right))]
-
-        sampled_idxs = range(num_total)
-        if num_total > num_samples:
-            sampled_idxs = random.sample(sampled_idxs, num_samples)
-        sampled_idxs = numpy.array(sampled_idxs)
-        sampled_idxs.sort()
-
-        si_left  = numpy.searchsorted(sampled_idxs, num_sum_left, 'left')
-        si_right = numpy.searchsorted(sampled_idxs, num_sum_right, 'left')
-        local_sampled_idxs = [sampled_idxs[l:r]-ns for l, r, ns in zip(si_left, si_right, num_sum_left)]
-
-        sub_data = pandas.concat(df.iloc[idx_start+idxs] for df, idx_start, idxs
-                                 in zip(self.__data.values(), index_start, local_sampled_idxs))
-        return TimelineTraceSlice(sub_data), num_total
-
-    def get_empty_time_slice(self):
-        return TimelineTraceSlice(pandas.DataFrame(columns=self.__columns))
-
-    def get_time_range(self):
-        return self.__time_min, self.__time_max
-
-    def get_kinds(self):
-        return list(self.__data.keys())
+from timeline_trace import TimelineTraceSlice, line_priority, load_trace, parse_viewer_args
+
+def row_ids(df):
+    """Identifies rows of `df` by hashing their values; equal rows are numbered."""
+    h = pandas.util.hash_pandas_object(df, index=False).values
+    order = numpy.argsort(h, kind='stable')
+    starts = numpy.flatnonzero(numpy.concatenate(([True], h[order][1:] != h[order][:-1])))
+    occurrence = numpy.empty(len(h), dtype=numpy.int64)
+    occurrence[order] = numpy.arange(len(h)) - \
+        numpy.repeat(starts, numpy.diff(numpy.append(starts, len(h))))
+    return h ^ line_priority(occurrence)
+
+class LruCache:
+    """Least-recently-used cache holding values up to `max_bytes` bytes in total.
+
+    It is shared by the query workers, so it is guarded by a lock.
+    """
+    def __init__(self, max_bytes):
+        self.__max_bytes = max_bytes
+        self.__entries = collections.OrderedDict()  # key -> (value, size)
+        self.__num_bytes = 0
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            self.__entries.move_to_end(key)
+            return entry[0]
+
+    def find(self, match):
+        """Returns the most recently used value for which `match(key, value)` is
+        True, or None."""
+        with self.__lock:
+            for key in reversed(self.__entries):
+                value = self.__entries[key][0]
+                if match(key, value):
+                    self.__entries.move_to_end(key)
+                    return value
+        return None
+
+    def put(self, key, value, size):
+        with self.__lock:
+            if key in self.__entries:
+                self.__num_bytes -= self.__entries.pop(key)[1]
+            if size > self.__max_bytes:
+                return
+            self.__entries[key] = (value, size)
+            self.__num_bytes += size
+            while self.__num_bytes > self.__max_bytes:
+                _, (_, evicted_size) = self.__entries.popitem(last=False)
+                self.__num_bytes -= evicted_size
+
+# The state a query depends on. Queries run in workers while the user may change the
+# state, so a snapshot is taken on the event loop and used for both the query and the
+# keys of its cached results.
+QueryState = collections.namedtuple('QueryState', (
+    'trace_version', 'visible_kinds', 'max_lanes', 'reduction_mode', 'num_samples',
+    'label_rate', 'active_main_tab', 'time_range', 'rank_range', 'num_pixels',
+    'rt_time_range', 'rt_rank_range', 'rt_num_pixels'))
 
 class TimelineTraceViewer:
-    __refreshed = { 'main': True, 'sub': True }
-    __slider_values = {
+    __default_slider_values = {
         'num_main_bar_samples': 10000,
         'label_rate': 0.0,
-        'num_rt_bar_samples': 10000,
-        'num_conc': 1
+        'max_lanes': 30
     }
-    __active_main_tab = 0
-
-    def __init__(self, trace):
+    __raster_tab_num = 2
+    # Memory cap of cached query results per session; see README.md
+    __default_cache_mb = 256
+    __plot_width = 1200
+    # Interval of checking a followed trace file for appended events
+    __follow_interval_ms = 1000
+    # A cached slice merged into pixels is cut out for a window in it if its pixels
+    # are up to this many times narrower than those of the window.
+    __max_cut_pixel_ratio = 3
+    __reduction_modes = ["Merge into pixels", "Random sampling"]
+
+    def __init__(self, trace, follow=False):
         print("Initializing viewer...")
+        # The trace is shared by sessions, and everything else is per session.
+        self.__slider_values = dict(self.__default_slider_values)
+        self.__active_main_tab = 0
+        self.__active_reduction_mode = 0
+        self.__main_tabs = ()
+        self.__raster_tab = None
+        self.__shown_rows = {}
+        # Refreshes are numbered per plot; queries run in workers, and a result is
+        # shown only if no refresh has been requested since its query started.
+        self.__refresh_requests = {'main': 0, 'sub': 0}
+        self.__refreshed_requests = {'main': 0, 'sub': 0}
+        self.__running_queries = {}
+        self.__query_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        # Windows next to the shown one are queried in another worker while idle.
+        self.__prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.__prefetch_futures = []
+        self.__query_cache = LruCache(
+            int(os.environ.get('MLOG_VIEWER_CACHE_MB', self.__default_cache_mb)) << 20)
+        self.__doc = bokeh.io.curdoc()
+        self.__rt_fig = None
         self.__trace = trace
+        # A followed trace grows while shown; cached results are keyed by its version.
+        self.__trace_version = trace.get_version() if follow else 0
+        self.__update_pool = None
+        self.__update_future = None
         self.__kinds = self.__trace.get_kinds()
         self.__visible_kinds = set(self.__kinds)
 
-        def big_palette(size, palette_func):
-            if size < 256:
-                return palette_func(size)
-            p = palette_func(256)
-            colors = []
-            for i in range(size):
-                idx = int(i * 256.0 / size)
-                colors.append(p[idx])
-            return colors
-
-        kind_colors = big_palette(len(self.__kinds), bokeh.palettes.viridis)
+        kind_colors, self.__kind_rgba = self.__get_kind_colors()
         color_mapper = bokeh.transform.factor_cmap(
             field_name='kind', factors=self.__kinds, palette=kind_colors)
+        self.__kind_color_mapper = color_mapper['transform']
 
         TOOLTIPS = [
             ('line', "@line"),
@@ -147,13 +146,18 @@ class TimelineTraceViewer:
         init_time_range = self.__trace.get_time_range()
         self.__main_time_range = init_time_range
         self.__rt_time_range = init_time_range
+        # each rank takes [rank, rank + 1] on the y axis
+        rank_min, rank_max = self.__trace.get_rank_range()
+        self.__rt_rank_range = (rank_min, rank_max)
+        init_y_range = (rank_min, rank_max + 1)
+        self.__main_y_range = init_y_range
 
         MainTabInfo = collections.namedtuple(
             'MainTabInfo', ('fig', 'migration_seg', 'bar_src', 'label_src', 'panel'))
 
         def make_main_tab(tab_num, backend, title, x_range, y_range):
             fig = bokeh.plotting.figure(
-                plot_width=1200, plot_height=800,
+                plot_width=self.__plot_width, plot_height=800,
                 x_range=x_range, y_range=y_range,
                 tools='hover,xwheel_zoom,ywheel_zoom,xpan,ypan,reset,crosshair,save,help',
                 active_drag='xpan', active_scroll='xwheel_zoom',
@@ -165,7 +169,9 @@ class TimelineTraceViewer:
             fig.ygrid.grid_line_color = 'black'
             fig.ygrid.ticker = yticker
 
-            bar_src, label_src = map(bokeh.models.ColumnDataSource, self.__get_main_data(tab_num))
+            bar_df, label_df, stats = self.__get_main_data(self.__get_query_state(), tab_num)
+            bar_src, label_src = map(self.__make_source, (bar_df, label_df))
+            self.__set_main_stats(stats)
 
             fig.hbar(
                 y='rank0_pos', left="t0", right="t1", height='height', legend='kind',
@@ -187,25 +193,56 @@ class TimelineTraceViewer:
             return MainTabInfo(fig=fig, migration_seg=migration_seg,
                                bar_src=bar_src, label_src=label_src, panel=panel)
 
-        webgl_main_tab = make_main_tab(0, 'webgl', "WebGL", init_time_range, None)
+        webgl_main_tab = make_main_tab(0, 'webgl', "WebGL", init_time_range, init_y_range)
         webgl_main_tab.fig.x_range.on_change('start', self.__on_change_time_range)
         webgl_main_tab.fig.x_range.on_change('end', self.__on_change_time_range)
+        webgl_main_tab.fig.y_range.on_change('start', self.__on_change_y_range)
+        webgl_main_tab.fig.y_range.on_change('end', self.__on_change_y_range)
 
         svg_main_tab = make_main_tab(
             1, 'svg', "SVG", webgl_main_tab.fig.x_range, webgl_main_tab.fig.y_range)
 
         self.__main_tabs = (webgl_main_tab, svg_main_tab)
-        main_tabs = bokeh.models.Tabs(tabs=[ti.panel for ti in self.__main_tabs])
-        main_tabs.on_change('active', self.__on_change_main_tab)
 
-        init_rt_bar_data = self.__get_rangetool_data(init_time_range)
-        self.__rt_bar_src = bokeh.models.ColumnDataSource(init_rt_bar_data)
+        RasterTabInfo = collections.namedtuple('RasterTabInfo', ('fig', 'image_src', 'panel'))
 
-        rt_fig = bokeh.plotting.figure(plot_width=1200, plot_height=150,
+        def make_raster_tab(title, x_range, y_range):
+            fig = bokeh.plotting.figure(
+                plot_width=self.__plot_width, plot_height=800,
+                x_range=x_range, y_range=y_range,
+                tools='xwheel_zoom,ywheel_zoom,xpan,ypan,reset,crosshair,save,help',
+                active_drag='xpan', active_scroll='xwheel_zoom')
+
+            yticker = bokeh.models.tickers.SingleIntervalTicker(interval=1)
+            fig.yaxis.ticker = yticker
+            fig.ygrid.grid_line_alpha = 1
+            fig.ygrid.grid_line_color = 'black'
+            fig.ygrid.ticker = yticker
+
+            image_data, stats = self.__get_raster_data(self.__get_query_state())
+            image_src = bokeh.models.ColumnDataSource(image_data)
+            self.__set_main_stats(stats)
+            fig.image_rgba(image='image', x='x', y='y', dw='dw', dh='dh', source=image_src)
+
+            panel = bokeh.models.Panel(child=fig, title=title)
+
+            return RasterTabInfo(fig=fig, image_src=image_src, panel=panel)
+
+        self.__raster_tab = make_raster_tab(
+            "Raster", webgl_main_tab.fig.x_range, webgl_main_tab.fig.y_range)
+
+        main_tabs = bokeh.models.Tabs(
+            tabs=[ti.panel for ti in self.__main_tabs] + [self.__raster_tab.panel])
+        main_tabs.on_change('active', self.__on_change_main_tab)
+
+        rt_fig = bokeh.plotting.figure(plot_width=self.__plot_width, plot_height=150,
                                        toolbar_location=None, output_backend='webgl')
+        self.__rt_fig = rt_fig
 
-        self.__rt_bar = rt_fig.hbar(y="rank0_pos", left="t0", right="t1", height=0.5,
-                                    color=color_mapper, alpha=0.8, source=self.__rt_bar_src)
+        self.__rt_image_src = bokeh.models.ColumnDataSource(
+            self.__get_rangetool_data(self.__get_query_state()))
+        rt_fig.image_rgba(image='image', x='x', y='y', dw='dw', dh='dh',
+                          source=self.__rt_image_src)
 
         range_tool = bokeh.models.RangeTool(x_range=webgl_main_tab.fig.x_range)
         rt_fig.add_tools(range_tool)
@@ -223,11 +260,12 @@ class TimelineTraceViewer:
         label_rate_slider = create_slider('label_rate',
             start=0, end=1, step=0.01, title="Rate for showing labels")
 
-        num_rt_bar_samples_slider = create_slider('num_rt_bar_samples',
-            start=1, end=100000, step=1, title="# of samples for sub plot")
+        max_lanes_slider = create_slider('max_lanes',
+            start=1, end=30, step=1, title="Max # of lanes per rank")
 
-        num_conc_slider = create_slider('num_conc',
-            start=1, end=30, step=1, title="# of concurrent events")
+        reduction_mode_button = bokeh.models.widgets.RadioButtonGroup(
+            labels=self.__reduction_modes, active=self.__active_reduction_mode)
+        reduction_mode_button.on_change('active', self.__on_change_reduction_mode)
 
         migrate_checkbox_group = \
             bokeh.models.widgets.CheckboxGroup(labels=["Show migrations"], active=[])
@@ -242,61 +280,335 @@ class TimelineTraceViewer:
                 labels=self.__kinds, active=list(range(len(self.__kinds))))
         self.__kind_checkbox_group.on_click(self.__on_click_kind_checkboxes)
 
-        curdoc = bokeh.io.curdoc()
+        curdoc = self.__doc
         row = bokeh.layouts.row
         column = bokeh.layouts.column
         left_layout = column(main_tabs, rt_fig)
-        right_layout = column(self.__sample_info_div,
+        right_layout = column(self.__sample_info_div, reduction_mode_button,
                               num_main_bar_samples_slider, label_rate_slider,
-                              num_rt_bar_samples_slider, num_conc_slider,
+                              max_lanes_slider,
                               migrate_checkbox_group,
                               kind_all_button, self.__kind_checkbox_group)
         curdoc.add_root(row(left_layout, right_layout))
         curdoc.add_periodic_callback(self.__on_timer, 100)
+        if follow:
+            # the file is read in a worker, as appended events may take time to read
+            self.__update_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            curdoc.add_periodic_callback(self.__on_follow_timer, self.__follow_interval_ms)
+        curdoc.on_session_destroyed(self.__on_session_destroyed)
         print("Viewer is initialized.")
 
-    def __get_main_data(self, tab_num):
-        is_active = tab_num == self.__active_main_tab
-        bar_sl, num_total = self.__get_sampled_time_slice(
-            self.__main_time_range, self.__slider_values['num_main_bar_samples']) \
-            if is_active else self.__get_empty_data()
-        if is_active:
-            self.__num_main_actual_events = num_total
+    def __get_kind_colors(self):
+        """Returns the colors of kinds and their RGBA (little-endian) values for
+        rasterization; the last RGBA value is for empty pixels (-1) and transparent."""
+        def big_palette(size, palette_func):
+            if size < 256:
+                return palette_func(size)
+            p = palette_func(256)
+            colors = []
+            for i in range(size):
+                idx = int(i * 256.0 / size)
+                colors.append(p[idx])
+            return colors
 
-        num_label_samples = math.ceil(bar_sl.size() * self.__slider_values['label_rate'])
-        label_sl = bar_sl.get_sampled_slice(num_label_samples)
-        return bar_sl.dataframe(), label_sl.dataframe()
+        def to_rgba(color, alpha):
+            r, g, b = (int(color[i:i+2], 16) for i in (1, 3, 5))
+            return r | (g << 8) | (b << 16) | (alpha << 24)
 
-    def __get_rangetool_data(self, time_range):
-        rangetool_sl, _ = self.__get_sampled_time_slice(
-            self.__rt_time_range, self.__slider_values['num_rt_bar_samples'])
-        return rangetool_sl.dataframe()
+        kind_colors = big_palette(len(self.__kinds), bokeh.palettes.viridis)
+        return kind_colors, numpy.array(
+            [to_rgba(color, 204) for color in kind_colors] + [0], dtype=numpy.uint32)
+
+    def __get_query_state(self):
+        """Returns a snapshot of the state that queries depend on. It is called on the
+        event loop."""
+        if self.__active_main_tab == self.__raster_tab_num:
+            fig = self.__raster_tab.fig if self.__raster_tab else None
+        else:
+            fig = self.__main_tabs[self.__active_main_tab].fig if self.__main_tabs else None
+        return QueryState(
+            trace_version=self.__trace_version,
+            visible_kinds=frozenset(self.__visible_kinds),
+            max_lanes=self.__slider_values['max_lanes'],
+            reduction_mode=self.__active_reduction_mode,
+            num_samples=self.__slider_values['num_main_bar_samples'],
+            label_rate=self.__slider_values['label_rate'],
+            active_main_tab=self.__active_main_tab,
+            time_range=self.__main_time_range,
+            rank_range=self.__get_visible_rank_range(),
+            num_pixels=self.__get_num_pixels(fig),
+            rt_time_range=self.__rt_time_range,
+            rt_rank_range=self.__rt_rank_range,
+            rt_num_pixels=self.__get_num_pixels(self.__rt_fig))
+
+    def __get_main_data(self, state, tab_num, preview=False):
+        """Returns bar and label data of a main tab, and the number of actual events
+        and the bucket width if the tab is active (or None otherwise).
+
+        If `preview` is True, bars of the active tab are a quick preview, or None is
+        returned if the bars themselves are about as quick to make.
+        """
+        is_active = tab_num == state.active_main_tab
+        if is_active:
+            get_slice = self.__get_preview_time_slice if preview else \
+                        self.__get_sampled_time_slice
+            result = get_slice(state, state.time_range)
+            if result is None:
+                return None
+            bar_sl, num_total = result
+        else:
+            bar_sl, num_total = self.__get_empty_data(state)
+        stats = (num_total, bar_sl.bucket_width()) if is_active else None
 
-    def __get_sampled_time_slice(self, time_range, num_samples):
-        sl, num_total = self.__trace.get_sampled_time_slice(time_range, self.__visible_kinds, num_samples)
-        sl.add_rank_pos(self.__slider_values['num_conc'])
+        num_label_samples = math.ceil(bar_sl.size() * state.label_rate)
+        label_sl = bar_sl.get_sampled_slice(num_label_samples)
+        return bar_sl.dataframe(), label_sl.dataframe(), stats
+
+    def __get_raster_data(self, state):
+        if state.active_main_tab != self.__raster_tab_num:
+            return {'image': [], 'x': [], 'y': [], 'dw': [], 'dh': []}, None
+        rank_min, rank_max = state.rank_range
+        raster, num_total, pixel_width = self.__trace.get_time_raster(
+            state.time_range, state.visible_kinds, state.num_pixels, (rank_min, rank_max))
+
+        start, end = state.time_range
+        return {
+            'image': [self.__kind_rgba[raster]],
+            'x': [start],
+            'y': [rank_min],
+            'dw': [end - start],
+            'dh': [rank_max - rank_min + 1],
+        }, (num_total, pixel_width)
+
+    def __set_main_stats(self, stats):
+        if stats is not None:
+            self.__num_main_actual_events, self.__main_bucket_width = stats
+
+    def __query_main_data(self, state):
+        return ([self.__get_main_data(state, i) for i in range(len(self.__main_tabs))],
+                self.__get_raster_data(state))
+
+    def __query_preview_main_data(self, state):
+        # the raster is quick to make whatever the window is
+        if state.active_main_tab == self.__raster_tab_num:
+            return None
+        tab_data = [self.__get_main_data(state, i, preview=True)
+                    for i in range(len(self.__main_tabs))]
+        if None in tab_data:
+            return None
+        return tab_data, self.__get_raster_data(state)
+
+    def __get_rangetool_data(self, state):
+        """Returns the overview of the whole trace as an image of ranks x pixels, which
+        depends only on the visible kinds and is cached."""
+        key = ('overview', state.trace_version, state.visible_kinds, state.rt_num_pixels)
+        cached = self.__query_cache.get(key)
+        if cached is not None:
+            return cached
+        raster, _, _ = self.__trace.get_time_raster(
+            state.rt_time_range, state.visible_kinds, state.rt_num_pixels)
+        rank_min, rank_max = state.rt_rank_range
+        start, end = state.rt_time_range
+        image = self.__kind_rgba[raster]
+        data = {
+            'image': [image],
+            'x': [start],
+            'y': [rank_min],
+            'dw': [end - start],
+            'dh': [rank_max - rank_min + 1],
+        }
+        self.__query_cache.put(key, data, image.nbytes)
+        return data
+
+    def __get_sampled_time_slice(self, state, time_range, pixel_scale=1):
+        """Returns the slice of `time_range` shown in the active tab and the number of
+        events.
+
+        The slice is merged into `pixel_scale` times as many pixels as the tab has, so
+        that a prefetched window can be cut out for windows in it.
+        """
+        num_pixels = state.num_pixels * pixel_scale if state.reduction_mode == 0 else None
+        # Slices are not modified once made, so cached ones are returned as they are
+        # when switching tabs or going back to a previous window.
+        key = self.__get_slice_key(state, time_range, num_pixels)
+        cached = self.__query_cache.get(key)
+        if cached is not None:
+            return cached
+        cut = self.__cut_cached_slice(state, time_range, num_pixels)
+        if cut is not None:
+            return cut
+        sl, num_total = self.__trace.get_sampled_time_slice(
+            time_range, state.visible_kinds, state.num_samples, num_pixels, state.rank_range)
+        sl.add_rank_pos(state.max_lanes)
+        self.__query_cache.put(key, (sl, num_total),
+                               sl.dataframe().memory_usage(deep=True).sum())
         return sl, num_total
 
-    def __get_empty_data(self):
+    def __get_preview_time_slice(self, state, time_range):
+        """Returns a quick preview of `__get_sampled_time_slice`, or None if the slice
+        itself is cached or about as quick to make."""
+        num_pixels = state.num_pixels if state.reduction_mode == 0 else None
+        key = self.__get_slice_key(state, time_range, num_pixels)
+        if self.__query_cache.get(key) is not None or \
+                self.__find_cached_slice(state, time_range, num_pixels) is not None:
+            return None
+        result = self.__trace.get_preview_time_slice(
+            time_range, state.visible_kinds, state.num_samples, num_pixels, state.rank_range,
+            state.num_pixels)
+        if result is not None:
+            result[0].add_rank_pos(state.max_lanes)
+        return result
+
+    def __get_slice_key(self, state, time_range, num_pixels):
+        # the first items are common to slices that may be cut out for each other
+        return ('slice', state.trace_version, state.visible_kinds, state.num_samples,
+                num_pixels is None, state.rank_range, state.max_lanes,
+                tuple(time_range), num_pixels)
+
+    def __find_cached_slice(self, state, time_range, num_pixels):
+        """Returns a cached slice of a window containing `time_range` and its window,
+        or None if there is no slice that can be cut out for `time_range`.
+
+        A slice having all events of its window can be cut out as it is. A slice
+        merged into pixels can be cut out if its pixels are at most as wide as those
+        of `time_range`, and not so narrow that it has many more runs.
+        """
+        start, end = time_range
+        family = self.__get_slice_key(state, time_range, num_pixels)[:-2]
+        if num_pixels is not None:
+            # windows are rounded to time units, which may make pixels of the same
+            # width slightly wider
+            pixel_width = max(1, math.floor(end) - math.ceil(start)) / num_pixels
+            max_pixel_width = (max(1, math.floor(end) - math.ceil(start)) + 2) / num_pixels
+
+        def match(key, value):
+            if key[:-2] != family or not (key[-2][0] <= start and end <= key[-2][1]):
+                return False
+            sl, num_total = value
+            if sl.bucket_width() is None:
+                return sl.size() == num_total
+            return num_pixels is not None and \
+                pixel_width / self.__max_cut_pixel_ratio <= sl.bucket_width() <= max_pixel_width
+
+        return self.__query_cache.find(match)
+
+    def __cut_cached_slice(self, state, time_range, num_pixels):
+        """Returns the slice of `time_range` cut out of a cached slice and the number
+        of events, or None if there is no such slice (see `__find_cached_slice`)."""
+        cached = self.__find_cached_slice(state, time_range, num_pixels)
+        if cached is None:
+            return None
+        sl, _ = cached
+        df = sl.dataframe()
+        df = df[(df['t1'] >= time_range[0]) & (df['t0'] <= time_range[1])].copy()
+        if sl.bucket_width() is None:
+            return TimelineTraceSlice(df), len(df)
+        num_total = self.__trace.count_events(time_range, state.visible_kinds, state.rank_range)
+        if num_total <= state.num_samples:
+            # all events of the window are shown instead of pixels
+            return None
+        return TimelineTraceSlice(df, sl.bucket_width(), sl.in_lanes()), num_total
+
+    def __get_visible_rank_range(self):
+        """Returns the range of ranks (inclusive) visible in the main plot."""
+        rank_min, rank_max = self.__trace.get_rank_range()
+        lo = min(max(math.floor(self.__main_y_range[0]), rank_min), rank_max)
+        hi = max(min(math.ceil(self.__main_y_range[1]) - 1, rank_max), lo)
+        return lo, hi
+
+    def __get_num_pixels(self, fig):
+        # inner_width (the width of the plot area) is known after the plot is rendered
+        if fig is not None and fig.inner_width:
+            return fig.inner_width
+        return self.__plot_width
+
+    def __get_empty_data(self, state):
         sl = self.__trace.get_empty_time_slice()
-        sl.add_rank_pos(self.__slider_values['num_conc'])
+        sl.add_rank_pos(state.max_lanes)
         return sl, 0
 
-    def __update_main_data(self):
-        for i, ti in enumerate(self.__main_tabs):
-            ti.bar_src.data, ti.label_src.data = \
-                map(bokeh.models.ColumnDataSource.from_df, self.__get_main_data(i))
+    def __update_main_data(self, data):
+        tab_data, (image_data, image_stats) = data
+        for ti, (bar_df, label_df, stats) in zip(self.__main_tabs, tab_data):
+            self.__update_source(ti.bar_src, bar_df)
+            self.__update_source(ti.label_src, label_df)
+            self.__set_main_stats(stats)
+        if image_stats is not None or self.__raster_tab.image_src.data['image']:
+            self.__raster_tab.image_src.data = image_data
+            self.__set_main_stats(image_stats)
         self.__sample_info_div.text = self.__get_sample_info()
 
-    def __update_rangetool_data(self):
-        self.__rt_bar_src.data = \
-            bokeh.models.ColumnDataSource.from_df(
-                self.__get_rangetool_data(self.__rt_time_range))
+    def __query_rangetool_data(self, state):
+        return self.__get_rangetool_data(state)
+
+    def __update_rangetool_data(self, data):
+        self.__rt_image_src.data = data
+
+    def __make_source(self, df):
+        src = bokeh.models.ColumnDataSource()
+        self.__update_source(src, df)
+        return src
+
+    def __update_source(self, src, df):
+        """Updates `src` to show the rows of `df`, sending only rows that changed.
+
+        Bokeh cannot remove rows from a ColumnDataSource, so slots of rows that left
+        are reused for entering rows by `patch`, the other entering rows are appended
+        by `stream`, and unused slots are hidden by setting their positions to NaN.
+        The data is replaced as a whole if most rows changed or most slots are unused.
+        """
+        df = df.reset_index(drop=True)
+        new_ids = row_ids(df)
+        shown = self.__shown_rows.get(src.id)
+        if shown is not None and shown[0] == list(df.columns):
+            _, shown_ids, hidden = shown
+            visible_slots = numpy.flatnonzero(~hidden)
+            entering = numpy.flatnonzero(~numpy.isin(new_ids, shown_ids[visible_slots]))
+            leaving = visible_slots[~numpy.isin(shown_ids[visible_slots], new_ids)]
+            free = numpy.concatenate((leaving, numpy.flatnonzero(hidden)))
+            num_unused = max(0, len(free) - len(entering))
+            if len(entering) <= len(df) / 2 and num_unused <= len(df):
+                self.__patch_source(src, df, new_ids, entering, free)
+                return
+        src.data = bokeh.models.ColumnDataSource.from_df(df)
+        self.__shown_rows[src.id] = (list(df.columns), new_ids, numpy.zeros(len(df), dtype=bool))
+
+    def __patch_source(self, src, df, new_ids, entering, free):
+        columns, shown_ids, hidden = self.__shown_rows[src.id]
+        reused, appended = entering[:len(free)], entering[len(free):]
+        slots, unused = free[:len(reused)], free[len(reused):]
+        to_hide = unused[~hidden[unused]]
+
+        patches = {}
+        if len(slots) > 0:
+            data = bokeh.models.ColumnDataSource.from_df(df.iloc[reused])
+            data['index'] = slots
+            patches = {name: list(zip(slots.tolist(), values.tolist()))
+                       for name, values in data.items()}
+        if len(to_hide) > 0:
+            for name in ('rank0_pos', 'rank1_pos'):
+                patches.setdefault(name, []).extend((slot, math.nan) for slot in to_hide.tolist())
+        if patches:
+            src.patch(patches)
+        if len(appended) > 0:
+            data = bokeh.models.ColumnDataSource.from_df(df.iloc[appended])
+            data['index'] = numpy.arange(len(hidden), len(hidden) + len(appended))
+            src.stream(data)
+
+        shown_ids, hidden = shown_ids.copy(), hidden.copy()
+        shown_ids[slots] = new_ids[reused]
+        hidden[slots] = False
+        hidden[to_hide] = True
+        self.__shown_rows[src.id] = (columns,
+                                     numpy.append(shown_ids, new_ids[appended]),
+                                     numpy.append(hidden, numpy.zeros(len(appended), dtype=bool)))
 
     def __get_sample_info(self):
         n_actual = self.__num_main_actual_events
         n_limit = self.__slider_values['num_main_bar_samples']
-        if n_actual > n_limit:
+        if self.__main_bucket_width is not None:
+            msg = "aggregated per {:g} ns".format(self.__main_bucket_width)
+        elif n_actual > n_limit:
             msg = "{:.3f} % sampled".format(n_limit / n_actual * 100)
         else:
             msg = "<strong>accurate</strong>"
@@ -311,13 +623,28 @@ class TimelineTraceViewer:
             self.__main_time_range = (self.__main_time_range[0], new)
             self.__request_refresh_main()
 
+    def __on_change_y_range(self, attr, old, new):
+        old_rank_range = self.__get_visible_rank_range()
+        if attr == 'start':
+            self.__main_y_range = (new, self.__main_y_range[1])
+        elif attr == 'end':
+            self.__main_y_range = (self.__main_y_range[0], new)
+        # events are queried per rank
+        if self.__get_visible_rank_range() != old_rank_range:
+            self.__request_refresh_main()
+
     def __on_change_main_tab(self, attr, old, new):
         self.__active_main_tab = new
         self.__request_refresh_main()
 
+    def __on_change_reduction_mode(self, attr, old, new):
+        self.__active_reduction_mode = new
+        self.__request_refresh_main()
+
     def __on_change_slider(self, name, attr, old, new):
         self.__slider_values[name] = new
-        self.__request_refresh_all()
+        # the overview does not depend on sliders
+        self.__request_refresh_main()
 
     def __on_click_migrate_checkboxes(self, active_list):
         is_visible = 0 in active_list
@@ -332,34 +659,155 @@ class TimelineTraceViewer:
         self.__kind_checkbox_group.active = \
             list(range(len(self.__kinds))) if 0 in active_list else []
 
+    def __prefetch_main_data(self):
+        """Queries windows around the shown one in the background, so that slices of
+        the next windows can be cut out of them when the user pans or zooms.
+
+        The window three widths wide is merged into pixels as wide as the shown ones,
+        which serves pans by up to a width and zooming out up to three times. The
+        shown window merged into pixels half as wide serves zooming in up to twice.
+        Sampled slices can be cut out only if they have all events of their windows.
+        """
+        state = self.__get_query_state()
+        if state.active_main_tab == self.__raster_tab_num:
+            return
+        start, end = state.time_range
+        width = end - start
+        windows = [((start - width, end + width), 3)]
+        if state.reduction_mode == 0:
+            windows.append(((start, end), 2))
+        for window, pixel_scale in windows:
+            self.__prefetch_futures.append(self.__prefetch_pool.submit(
+                self.__get_sampled_time_slice, state, window, pixel_scale))
+
     def __request_refresh_main(self):
-        self.__refreshed['main'] = False
+        self.__refresh_requests['main'] += 1
+        # windows being prefetched may be no longer next to the new one
+        for future in self.__prefetch_futures:
+            future.cancel()
+        self.__prefetch_futures = []
 
     def __request_refresh_all(self):
         self.__request_refresh_main()
-        self.__refreshed['sub'] = False
+        self.__refresh_requests['sub'] += 1
 
     def __on_timer(self):
-        def refresh(plot_name, update_func):
-            if not self.__refreshed[plot_name]:
-                start_time = datetime.datetime.now()
+        # A plot is refreshed once its previous query is done, so requests made in
+        # the meantime are merged into one query of the newest state. The main plot
+        # first shows a quick preview if the exact data takes time.
+        for plot_name, query_funcs, update_func in (
+                ('main', (self.__query_preview_main_data, self.__query_main_data),
+                 self.__update_main_data),
+                ('sub', (self.__query_rangetool_data,), self.__update_rangetool_data)):
+            request = self.__refresh_requests[plot_name]
+            if request != self.__refreshed_requests[plot_name] and \
+                    plot_name not in self.__running_queries:
                 print("Refreshing {} plot...".format(plot_name))
-                update_func()
-                self.__refreshed[plot_name] = True
-                end_time = datetime.datetime.now()
-                print("Refreshed {} plot in {} sec."
-                      .format(plot_name, (end_time-start_time).total_seconds()))
+                self.__start_query(plot_name, request, query_funcs, update_func,
+                                   datetime.datetime.now(), self.__get_query_state())
+
+    def __start_query(self, plot_name, request, query_funcs, update_func, start_time, state):
+        # all stages of a refresh query the state of its request
+        future = self.__query_pool.submit(query_funcs[0], state)
+        self.__running_queries[plot_name] = future
+        # The callback runs in the worker, so the result is passed to the event loop,
+        # which is the only thread allowed to modify the document.
+        future.add_done_callback(functools.partial(
+            self.__on_query_done, plot_name, request, query_funcs, update_func, start_time,
+            state))
+
+    def __on_query_done(self, plot_name, request, query_funcs, update_func, start_time, state,
+                        future):
+        self.__doc.add_next_tick_callback(functools.partial(
+            self.__finish_refresh, plot_name, request, query_funcs, update_func, start_time,
+            state, future))
+
+    def __finish_refresh(self, plot_name, request, query_funcs, update_func, start_time, state,
+                         future):
+        del self.__running_queries[plot_name]
+        if request != self.__refresh_requests[plot_name]:
+            # the next timer tick queries the newest state, and the remaining stages
+            # of this refresh are not run
+            print("Dropped a stale {} plot.".format(plot_name))
+            return
         try:
-            refresh('main', self.__update_main_data)
-            refresh('sub', self.__update_rangetool_data)
+            result = future.result()
+            # a stage returns None if it has nothing to show
+            if result is not None:
+                update_func(result)
         except:
             # See the trace inside the callback for debugging.
             traceback.print_exc()
             raise
+        if len(query_funcs) > 1:
+            self.__start_query(plot_name, request, query_funcs[1:], update_func, start_time,
+                               state)
+            return
+        self.__refreshed_requests[plot_name] = request
+        end_time = datetime.datetime.now()
+        print("Refreshed {} plot in {} sec."
+              .format(plot_name, (end_time-start_time).total_seconds()))
+        if plot_name == 'main':
+            self.__prefetch_main_data()
+
+    def __on_follow_timer(self):
+        if self.__update_future is None:
+            self.__update_future = self.__update_pool.submit(self.__trace.update)
+            self.__update_future.add_done_callback(self.__on_update_done)
+
+    def __on_update_done(self, future):
+        self.__doc.add_next_tick_callback(functools.partial(self.__on_trace_updated, future))
+
+    def __on_trace_updated(self, future):
+        """Shows events appended to the followed trace. Views showing the whole trace
+        are extended to the new ranges of time and ranks."""
+        self.__update_future = None
+        try:
+            future.result()
+        except:
+            # See the trace inside the callback for debugging.
+            traceback.print_exc()
+            raise
+        version = self.__trace.get_version()
+        if version == self.__trace_version:
+            return
+        self.__trace_version = version
+
+        kinds = self.__trace.get_kinds()
+        if kinds != self.__kinds:
+            # new kinds are shown
+            self.__visible_kinds = self.__visible_kinds | (set(kinds) - set(self.__kinds))
+            self.__kinds = kinds
+            kind_colors, self.__kind_rgba = self.__get_kind_colors()
+            self.__kind_color_mapper.update(factors=kinds, palette=kind_colors)
+            self.__kind_checkbox_group.update(
+                labels=kinds,
+                active=[i for i, kind in enumerate(kinds) if kind in self.__visible_kinds])
+
+        old_time_range, self.__rt_time_range = \
+            self.__rt_time_range, self.__trace.get_time_range()
+        old_rank_range, self.__rt_rank_range = \
+            self.__rt_rank_range, self.__trace.get_rank_range()
+        rank_min, rank_max = self.__rt_rank_range
+        x_range, y_range = self.__main_tabs[0].fig.x_range, self.__main_tabs[0].fig.y_range
+        if x_range.end >= old_time_range[1]:
+            x_range.end = self.__rt_time_range[1]
+        if y_range.start <= old_rank_range[0] and y_range.end >= old_rank_range[1] + 1:
+            y_range.update(start=rank_min, end=rank_max + 1)
+        x_range.update(reset_start=self.__rt_time_range[0], reset_end=self.__rt_time_range[1])
+        y_range.update(reset_start=rank_min, reset_end=rank_max + 1)
+        self.__request_refresh_all()
 
-trace = TimelineTrace()
-if len(sys.argv) < 2:
-    sys.exit("{} [CSV path]".format(sys.argv[0]))
-trace.read_csv(sys.argv[1])
-viewer = TimelineTraceViewer(trace)
-
+    def __on_session_destroyed(self, session_context):
+        self.__query_pool.shutdown(wait=False)
+        for future in self.__prefetch_futures:
+            future.cancel()
+        self.__prefetch_pool.shutdown(wait=False)
+        if self.__update_pool is not None:
+            self.__update_pool.shutdown(wait=False)
+
+trace_args = parse_viewer_args(sys.argv[1:])
+if trace_args is None:
+    sys.exit("{} [trace path or pattern]... [--follow] [--rank-offsets=auto|N,N,...]"
+             .format(sys.argv[0]))
+viewer = TimelineTraceViewer(load_trace(**trace_args), trace_args['follow'])
@@ -1,5 +1,23 @@
+import os
 import sys
 
+import timeline_trace
+
+# sys.argv of the server is only available while this module is loaded.
+trace_args = timeline_trace.parse_viewer_args(sys.argv[1:])
+
+# The trace is read here rather than in `on_server_loaded`, because this module is
+# loaded before `bokeh serve --num-procs N` forks worker processes. Workers then
+# share the memory-mapped store of the trace (and its pages in memory) instead of
+# reading it N times.
+if trace_args is not None:
+    timeline_trace.load_trace(**trace_args)
+
+# A server started by run_viewer.bash is used by a single user, and it stops when
+# the user closes the tab; other servers keep serving the other sessions.
+exit_on_close = os.environ.get('MLOG_VIEWER_EXIT_ON_CLOSE') == '1'
+
 def on_session_destroyed(session_context):
-    print("session closed; stopping server...")
-    sys.exit(0)
+    if exit_on_close:
+        print("session closed; stopping server...")
+        sys.exit(0)
@@ -0,0 +1,1869 @@
+import os
+import atexit
+import io
+import fcntl
+import json
+import glob
+import hashlib
+import shutil
+import site
+import gzip
+import lzma
+import tempfile
+import math
+import time
+import collections
+import heapq
+import itertools
+import threading
+import concurrent.futures
+import multiprocessing
+import pandas
+import numpy
+
+def segment_searchsorted(a, starts, ends, v, side='left'):
+    """Vectorized `numpy.searchsorted` on many sorted segments `a[starts[i]:ends[i]]`.
+
+    Returns indices in `a`. Only O(log n) elements of each segment are accessed,
+    so `a` can be a large memory-mapped array.
+    """
+    lo = numpy.array(starts, dtype=numpy.int64)
+    hi = numpy.array(ends, dtype=numpy.int64)
+    v = numpy.broadcast_to(v, lo.shape)
+    active = numpy.nonzero(lo < hi)[0]
+    while active.size > 0:
+        mid = (lo[active] + hi[active]) // 2
+        if side == 'left':
+            go_right = a[mid] < v[active]
+        else:
+            go_right = a[mid] <= v[active]
+        lo[active[go_right]] = mid[go_right] + 1
+        hi[active[~go_right]] = mid[~go_right]
+        active = active[lo[active] < hi[active]]
+    return lo
+
+def count_not_greater(keys, values):
+    """Counts tuples in `keys` lexicographically not greater than each tuple in `values`.
+
+    This is where `numpy.searchsorted(..., side='right')` would insert the tuples if
+    keys were sorted. `keys` and `values` are sequences of columns, the primary one
+    first.
+    """
+    num_keys = len(keys[0])
+    order = numpy.lexsort([numpy.concatenate((k, v)) for k, v in zip(keys, values)][::-1])
+    # the sort is stable, so keys precede equal values
+    is_key = order < num_keys
+    result = numpy.empty(len(order) - num_keys, dtype=numpy.int64)
+    result[order[~is_key] - num_keys] = numpy.cumsum(is_key)[~is_key]
+    return result
+
+def concat_ranges(starts, ends):
+    """Returns `numpy.concatenate([numpy.arange(s, e) for s, e in zip(starts, ends)])`."""
+    counts = numpy.maximum(ends - starts, 0)
+    offsets = numpy.repeat(starts - (counts.cumsum() - counts), counts)
+    return numpy.arange(counts.sum()) + offsets
+
+def is_lexsorted(keys):
+    """Returns True if `numpy.lexsort(keys)` would keep the order, i.e., elements are
+    sorted by the last key, then by the second last key, and so on."""
+    is_tie = numpy.ones(max(len(keys[-1]) - 1, 0), dtype=bool)
+    for key in reversed(keys):
+        key = numpy.asarray(key)
+        if (is_tie & (key[1:] < key[:-1])).any():
+            return False
+        is_tie &= key[1:] == key[:-1]
+    return True
+
+def radix_argsort(keys):
+    """Returns the stable sort order of non-negative integers `keys`, sorting them
+    by 16-bit digits from the lowest, which numpy sorts by radix sort, so that it
+    takes linear time for keys of a few digits."""
+    keys = numpy.asarray(keys)
+    order = numpy.arange(len(keys))
+    max_key = int(keys.max()) if len(keys) > 0 else 0
+    shift = 0
+    while shift == 0 or max_key >> shift > 0:
+        digit = ((keys[order] >> shift) & 0xFFFF).astype(numpy.uint16)
+        order = order[numpy.argsort(digit, kind='stable')]
+        shift += 16
+    return order
+
+def line_priority(line):
+    """Pseudo-random priorities of events given by hashing their line numbers.
+
+    The hash (the finalizer of SplitMix64) is a bijection on 64-bit integers, so
+    events never tie and sampling by the lowest priorities is deterministic.
+    """
+    x = numpy.asarray(line).astype(numpy.uint64) + numpy.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return x ^ (x >> numpy.uint64(31))
+
+def priority_level(priority):
+    """Returns the number of leading zero bits of priorities, up to 32; events of
+    level `l` or higher are those with priorities less than 2^(64-l)."""
+    # the upper half of a priority is exact as a float, and so is its exponent
+    high = (numpy.asarray(priority, dtype=numpy.uint64) >> numpy.uint64(32)) \
+        .astype(numpy.float64)
+    return numpy.where(high > 0, 32 - numpy.frexp(high)[1], 32)
+
+def smallest_int_dtype(min_value, max_value):
+    """Returns the smallest signed integer dtype (at least 16-bit) holding the range."""
+    for dtype in (numpy.int16, numpy.int32):
+        info = numpy.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return numpy.dtype(dtype)
+    return numpy.dtype(numpy.int64)
+
+def reduce_sorted(keys, values):
+    """Sums up `values` for each run of equal values in the sorted array `keys`."""
+    if len(keys) == 0:
+        return keys, values
+    starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], numpy.add.reduceat(values, starts)
+
+def map_in_threads(func, args, num_threads):
+    """Yields `func(*a)` for each `a` in `args` in order, calling it in up to
+    `num_threads` threads; numpy releases the GIL in most of its work. Only that
+    many calls are in flight, so that their memory use is bounded."""
+    if num_threads <= 1:
+        for a in args:
+            yield func(*a)
+        return
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as pool:
+        futures = collections.deque()
+        for a in args:
+            if len(futures) == num_threads:
+                yield futures.popleft().result()
+            futures.append(pool.submit(func, *a))
+        while futures:
+            yield futures.popleft().result()
+
+def assign_lanes(rank, t0, t1):
+    """Assigns each event the lowest lane of its rank that is free when it begins.
+
+    Events are placed in the order of t0, longer ones first, and events that only
+    touch do not overlap. Returns lanes in the order of the given events.
+    """
+    lanes = numpy.zeros(len(t0), dtype=numpy.int64)
+    # empty events overlap nothing and stay in lane 0
+    events = numpy.flatnonzero(t0 < t1)
+    order = events[numpy.lexsort((-t1[events], t0[events], rank[events]))]
+    rank, t0, t1 = rank[order], t0[order], t1[order]
+
+    # If events of a rank nest properly, the lowest free lane of an event is the
+    # number of events still running when it begins.
+    lane = numpy.arange(len(rank)) - count_not_greater((rank, t1), (rank, t0))
+
+    # That is the case if no events in a lane overlap and each event is contained
+    # in the last event that begins no later in the lane below. Where no event is
+    # running (lane 0), all lanes are free, so events are split into groups there
+    # and only groups with events not nested are assigned greedily.
+    by_lane = numpy.lexsort((t0, lane, rank))
+    r, l, b0, b1 = rank[by_lane], lane[by_lane], t0[by_lane], t1[by_lane]
+    parent = count_not_greater((r, l, b0), (r, l - 1, b0)) - 1
+    nested = (l == 0) | ((r[parent] == r) & (l[parent] == l - 1) & (b1[parent] >= b1))
+    nested[1:] &= (r[1:] != r[:-1]) | (l[1:] != l[:-1]) | (b0[1:] >= b1[:-1])
+    group_starts = numpy.flatnonzero(lane == 0)
+    group_ends = numpy.append(group_starts[1:], len(rank))
+    for i in numpy.unique(numpy.searchsorted(group_starts, by_lane[~nested], 'right') - 1):
+        s, e = group_starts[i], group_ends[i]
+        lane[s:e] = _assign_lanes_greedy(t0[s:e], t1[s:e])
+
+    lanes[order] = lane
+    return lanes
+
+def _assign_lanes_greedy(t0, t1):
+    # events are sorted in the order they are placed
+    lane = numpy.zeros(len(t0), dtype=numpy.int64)
+    running = []  # (t1, lane) of running events
+    free = []
+    num_lanes = 0
+    for i, (begin, end) in enumerate(zip(t0.tolist(), t1.tolist())):
+        while running and running[0][0] <= begin:
+            heapq.heappush(free, heapq.heappop(running)[1])
+        if free:
+            lane[i] = heapq.heappop(free)
+        else:
+            lane[i] = num_lanes
+            num_lanes += 1
+        heapq.heappush(running, (end, lane[i]))
+    return lane
+
+# Leading bytes of compressed files and their formats
+COMPRESSION_MAGICS = [(b'\x1f\x8b', 'gzip'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zstd')]
+
+def get_compression(input_path):
+    """Returns the format ('gzip', 'xz' or 'zstd') of a compressed file, or None if
+    the file is not compressed."""
+    with open(input_path, 'rb') as f:
+        head = f.read(8)
+    for magic, compression in COMPRESSION_MAGICS:
+        if head.startswith(magic):
+            return compression
+    return None
+
+def open_trace(input_path):
+    """Opens a trace file for reading as a binary stream, which is decompressed on
+    the fly if the file is compressed. zstd needs the `zstandard` package."""
+    compression = get_compression(input_path)
+    if compression == 'gzip':
+        return gzip.open(input_path, 'rb')
+    if compression == 'xz':
+        return lzma.open(input_path, 'rb')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("{}: reading zstd-compressed traces needs the zstandard package"
+                             .format(input_path)) from None
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(input_path, 'rb'), read_across_frames=True, closefd=True)
+    return open(input_path, 'rb')
+
+def parse_csv_range(input_path, start, end, columns):
+    """Parses lines of a CSV trace in the byte range [start, end) of the file (see
+    `parse_csv_data`)."""
+    with open(input_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return parse_csv_data(data, columns)
+
+def parse_csv_data(data, columns):
+    """Parses lines of a CSV trace.
+
+    Returns the columns of the events in compact types, and kinds as categorical
+    codes into a table of kind names, in the form of chunks read by `TimelineTrace`.
+    """
+    dtype = {'rank0': numpy.int64, 't0': numpy.int64, 'rank1': numpy.int64,
+             't1': numpy.int64, 'kind': 'category'}
+    # kinds are taken as they are, e.g., an empty or missing kind is the kind ''
+    # rather than NaN, which has no category code
+    df = pandas.read_csv(io.BytesIO(data), names=columns, dtype=dtype, na_filter=False)
+    del data
+    def compact(values):
+        if len(values) == 0:
+            return values
+        return values.astype(smallest_int_dtype(values.min(), values.max()))
+    kind = df['kind'].cat
+    return (compact(df['rank0'].values), df['t0'].values, compact(df['rank1'].values),
+            df['t1'].values, kind.codes.values, list(kind.categories))
+
+class EmptyTraceError(ValueError):
+    """Raised when a trace (or a range of a trace file) has no events."""
+
+class Progress:
+    """Prints the number of events processed so far and the rate at most once a
+    second."""
+    def __init__(self, label, total=None):
+        self.__label = label
+        self.__total = total
+        self.__count = 0
+        self.__start_time = self.__print_time = time.monotonic()
+
+    def add(self, count):
+        self.__count += count
+        now = time.monotonic()
+        if now - self.__print_time >= 1:
+            self.__print_time = now
+            self.__print(now)
+
+    def finish(self):
+        self.__print(time.monotonic())
+
+    def __print(self, now):
+        count = "{:,}".format(self.__count) if self.__total is None else \
+                "{:,} / {:,}".format(self.__count, self.__total)
+        rate = self.__count / max(now - self.__start_time, 1e-9)
+        print("{}: {} events ({:,.0f} events/s)".format(self.__label, count, rate))
+
+class TimelineTraceSlice:
+    def __init__(self, df, bucket_width=None, in_lanes=True):
+        self.__df = df
+        self.__df.reset_index(inplace=True, drop=True)
+        self.__bucket_width = bucket_width
+        self.__in_lanes = in_lanes
+
+    def bucket_width(self):
+        """Width of time buckets if events are aggregated, or None otherwise."""
+        return self.__bucket_width
+
+    def in_lanes(self):
+        """True if rows are placed in lanes of their ranks, or False if they are
+        aggregated over whole ranks."""
+        return self.__in_lanes
+
+    def get_sampled_slice(self, num_samples):
+        if self.size() <= num_samples:
+            return TimelineTraceSlice(self.__df)
+        line = self.__df['line'].values
+        priority = line_priority(line)
+        is_run = line < 0
+        if is_run.any():
+            # runs merged into pixels have no line numbers, so their values are hashed
+            priority[is_run] = pandas.util.hash_pandas_object(
+                self.__df.loc[is_run, ['rank0', 't0', 't1', 'kind']], index=False).values
+        idxs = numpy.sort(numpy.argsort(priority, kind='stable')[:num_samples])
+        return TimelineTraceSlice(self.__df.iloc[idxs])
+
+    def dataframe(self):
+        return self.__df
+
+    def size(self):
+        return len(self.__df.index)
+
+    def add_rank_pos(self, max_lanes):
+        """Places events in the lanes of their ranks. Ranks with more than `max_lanes`
+        lanes wrap lanes around."""
+        num_lanes = numpy.minimum(self.__df.loc[:, 'num_lanes'], max_lanes)
+        self.__df = self.__df.assign(
+            rank0_pos=self.__df.loc[:, 'rank0']+
+                      (numpy.mod(self.__df.loc[:, 'lane'], num_lanes)+0.5)/num_lanes,
+            height=1/num_lanes)
+        self.__df = self.__df.assign(
+            rank1_pos=numpy.where(self.__df.loc[:, 'rank0'] == self.__df.loc[:, 'rank1'],
+                                  self.__df.loc[:, 'rank0_pos'],
+                                  self.__df.loc[:, 'rank1']+0.5))
+
+class TimelineTrace:
+    COLUMNS = ['rank0', 't0', 'rank1', 't1', 'kind']
+    SLICE_COLUMNS = ['line', 'rank0', 't0', 'rank1', 't1', 'kind', 'duration', 'lane',
+                     'num_lanes']
+    STORE_COLUMNS = ['line', 'rank0', 't0', 'rank1', 't1', 'kind', 'lane']
+    # Columns of sorted runs written while building the store; the first four are
+    # the sort key.
+    RUN_COLUMNS = ['rank0', 'duration_class', 't0', 'line', 'rank1', 't1', 'kind']
+
+    # See `mlog_flush_binary` in include/mlog/mlog.h
+    BINARY_MAGIC = b'MLOGBIN1'
+    BINARY_HEADER_DTYPE = numpy.dtype([
+        ('magic', 'S8'), ('num_kinds', '<u8'), ('num_records', '<u8')])
+    BINARY_RECORD_DTYPE = numpy.dtype([
+        ('rank0', '<i4'), ('rank1', '<i4'), ('t0', '<u8'), ('t1', '<u8'), ('kind', '<u8')])
+
+    # Number of events processed at once while loading a trace
+    CHUNK_SIZE = 1 << 22
+    # CSV traces are split into chunks of about this many bytes, which are parsed
+    # in parallel by this many processes.
+    CSV_CHUNK_BYTES = 1 << 27
+    NUM_READ_WORKERS = os.cpu_count() or 1
+
+    # Memory used to build the store is kept within about this many bytes (see
+    # README.md). Sorting and merging events take about `BYTES_PER_EVENT` bytes per
+    # event in memory, and a CSV chunk being parsed takes about
+    # `CSV_BYTES_IN_MEMORY` times its size.
+    MEMORY_BUDGET = int(os.environ.get('MLOG_MEMORY_BUDGET_MB', 4096)) << 20
+    BYTES_PER_EVENT = 160
+    CSV_BYTES_IN_MEMORY = 4
+
+    # Events in each kind are partitioned into duration classes; events whose
+    # duration is in [2^(c-1), 2^c) belong to the class c.
+    NUM_DURATION_CLASSES = 65
+
+    # Level-of-detail (LOD) pyramid: occupancy of each (rank, kind) is aggregated in
+    # power-of-two time buckets. The finest level has about this many events per
+    # bucket of each rank, and each coarser level doubles the bucket width.
+    LOD_EVENTS_PER_BUCKET = 4
+
+    # Windows with up to this many events are decimated per pixel from raw events;
+    # larger ones are drawn from the LOD pyramid.
+    DECIMATION_MAX_EVENTS = 1 << 20
+    DECIMATION_BLOCK_SIZE = 1 << 22
+
+    # Rows of events of each `priority_level` from this level up are listed, so
+    # that sampling a window with many events scans only a level with about twice
+    # as many events as samples. About a quarter of events are listed.
+    SAMPLE_MIN_LEVEL = 3
+
+    # Bump this when the layout of the store changes
+    STORE_VERSION = 9
+    STORE_SUFFIX = '.mlogcache'
+
+    # Line numbers of events read from the middle of a file (see `read`) begin here
+    __line_offset = 0
+
+    def read(self, input_path, start=0, end=None, line_offset=0):
+        """Reads events in bytes [start, end) of a trace file, or to the end of it if
+        `end` is None. A range starting after the beginning of the file holds events
+        appended to a growing trace; their line numbers begin at `line_offset`, and
+        their store is private to this object and removed at exit.
+
+        Files compressed with gzip, xz or zstd are decompressed while being read,
+        and only as a whole."""
+        if (start > 0 or end is not None) and get_compression(input_path) is not None:
+            raise ValueError("{}: compressed traces can only be read as a whole"
+                             .format(input_path))
+        self.__line_offset = line_offset
+        if self.__is_binary(input_path):
+            return self.read_binary(input_path, start, end)
+        return self.read_csv(input_path, start, end)
+
+    def read_files(self, input_paths, rank_offsets=None):
+        """Reads trace files (e.g., one per process) as one trace.
+
+        `input_paths` are paths or glob patterns, which are expanded in sorted order.
+        Ranks of the i-th file are shifted by `rank_offsets[i]`; if `rank_offsets` is
+        'auto', ranks of each file are shifted to follow those of the previous files.
+        Events of the files are merged with the sorted runs of the store, and they
+        are not sorted again if they are in order of time per rank.
+        """
+        paths = []
+        for pattern in input_paths:
+            matches = [pattern] if os.path.exists(pattern) else sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError("{}: no such trace files".format(pattern))
+            paths.extend(matches)
+        if rank_offsets is None and len(paths) == 1:
+            return self.read(paths[0])
+        if rank_offsets not in (None, 'auto') and len(rank_offsets) != len(paths):
+            raise ValueError("{} rank offsets are given for {} trace files"
+                             .format(len(rank_offsets), len(paths)))
+
+        def chunks():
+            offset = 0
+            for i, path in enumerate(paths):
+                print("Reading {} ({}/{})...".format(path, i + 1, len(paths)))
+                if rank_offsets is None:
+                    offset = 0
+                elif rank_offsets != 'auto':
+                    offset = rank_offsets[i]
+                next_offset = offset
+                for rank0, t0, rank1, t1, codes, kind_names in self.__read_chunks(path):
+                    rank0 = numpy.asarray(rank0, dtype=numpy.int64) + offset
+                    rank1 = numpy.asarray(rank1, dtype=numpy.int64) + offset
+                    if len(t0) > 0:
+                        next_offset = max(next_offset, rank0.max() + 1, rank1.max() + 1)
+                    yield rank0, t0, rank1, t1, codes, kind_names
+                offset = int(next_offset)
+
+        key = {
+            'files': [self.__get_file_key(path) for path in paths],
+            'rank_offsets': rank_offsets,
+            'version': self.STORE_VERSION,
+        }
+        # The store of the files is named after them and placed next to the first one
+        name_hash = hashlib.sha1(json.dumps(
+            [os.path.abspath(path) for path in paths] + [rank_offsets]).encode()).hexdigest()
+        name = os.path.join(os.path.dirname(paths[0]), 'mlog-' + name_hash[:16])
+        return self.__load_store(paths[0], self.__find_store_dir(name), key, chunks())
+
+    @classmethod
+    def __is_binary(cls, input_path):
+        with open_trace(input_path) as f:
+            return f.read(len(cls.BINARY_MAGIC)) == cls.BINARY_MAGIC
+
+    def __read_chunks(self, input_path):
+        if self.__is_binary(input_path):
+            return self.__read_binary_chunks(input_path)
+        return self.__read_csv_chunks(input_path)
+
+    @classmethod
+    def find_complete_end(cls, input_path, start=0):
+        """Returns the end of the last complete line (or block of a binary trace) at
+        or after `start` in a file that may be being written."""
+        size = os.path.getsize(input_path)
+        with open(input_path, 'rb') as f:
+            if f.read(len(cls.BINARY_MAGIC)) == cls.BINARY_MAGIC:
+                end = start
+                while True:
+                    block_end = cls.__get_binary_block_end(f, end, size)
+                    if block_end is None:
+                        return end
+                    end = block_end
+            pos = size
+            while pos > start:
+                length = min(1 << 20, pos - start)
+                f.seek(pos - length)
+                i = f.read(length).rfind(b'\n')
+                if i >= 0:
+                    return pos - length + i + 1
+                pos -= length
+            return start
+
+    @classmethod
+    def __get_binary_block_end(cls, f, offset, size):
+        # Returns None if the block at `offset` is not completely written yet
+        if offset + cls.BINARY_HEADER_DTYPE.itemsize > size:
+            return None
+        f.seek(offset)
+        header = numpy.frombuffer(f.read(cls.BINARY_HEADER_DTYPE.itemsize), cls.BINARY_HEADER_DTYPE)[0]
+        if header['magic'] != cls.BINARY_MAGIC:
+            raise ValueError("{}: invalid binary trace at offset {}".format(f.name, offset))
+        offset += cls.BINARY_HEADER_DTYPE.itemsize
+        for i in range(int(header['num_kinds'])):
+            if offset + 8 > size:
+                return None
+            f.seek(offset)
+            length = int(numpy.frombuffer(f.read(8), '<u8')[0])
+            offset += 8 + (length + 7) // 8 * 8
+        offset += int(header['num_records']) * cls.BINARY_RECORD_DTYPE.itemsize
+        return offset if offset <= size else None
+
+    def read_csv(self, input_path, start=0, end=None):
+        return self.__load(input_path, self.__read_csv_chunks(input_path, start, end),
+                           start, end)
+
+    def __read_csv_chunks(self, input_path, start=0, end=None):
+        print("Reading CSV...")
+        # Chunks are parsed in worker processes and yielded in the order of the
+        # file; only a few chunks per worker are in flight, and they take up to a
+        # half of the memory budget.
+        max_in_flight = 2 * self.NUM_READ_WORKERS
+        chunk_bytes = max(1 << 20, min(self.CSV_CHUNK_BYTES, self.MEMORY_BUDGET // 2 //
+                                       (self.CSV_BYTES_IN_MEMORY * max_in_flight)))
+        if get_compression(input_path) is None:
+            tasks = iter([(parse_csv_range, input_path, range_start, range_end, self.COLUMNS)
+                          for range_start, range_end in
+                          self.__split_lines(input_path, chunk_bytes, start, end)])
+        else:
+            # A compressed file is decompressed in this process, while workers parse
+            # the blocks decompressed before.
+            tasks = ((parse_csv_data, data, self.COLUMNS)
+                     for data in self.__read_line_blocks(input_path, chunk_bytes))
+        first_tasks = list(itertools.islice(tasks, 2))
+        tasks = itertools.chain(first_tasks, tasks)
+        if len(first_tasks) == 1 or self.NUM_READ_WORKERS == 1:
+            for func, *args in tasks:
+                yield func(*args)
+            return
+        # Workers are started by a fork server rather than forked from this process,
+        # which may have other threads running (e.g., the viewer following a trace);
+        # they import this module from its directory, which may be off `sys.path` by
+        # then (as the viewer's is once bokeh has loaded it).
+        with concurrent.futures.ProcessPoolExecutor(
+                self.NUM_READ_WORKERS, mp_context=multiprocessing.get_context('forkserver'),
+                initializer=site.addsitedir,
+                initargs=(os.path.dirname(os.path.abspath(__file__)),)) as pool:
+            futures = collections.deque()
+            for func, *args in tasks:
+                if len(futures) == max_in_flight:
+                    yield futures.popleft().result()
+                futures.append(pool.submit(func, *args))
+            while futures:
+                yield futures.popleft().result()
+
+    @staticmethod
+    def __read_line_blocks(input_path, chunk_bytes):
+        """Yields the (decompressed) contents of a trace file in blocks of about
+        `chunk_bytes` bytes that end at line boundaries."""
+        with open_trace(input_path) as f:
+            rest = b''
+            while True:
+                data = f.read(chunk_bytes)
+                if not data:
+                    break
+                data = rest + data
+                end = data.rfind(b'\n') + 1
+                rest = data[end:]
+                if end > 0:
+                    yield data[:end]
+            if rest:
+                yield rest
+
+    @staticmethod
+    def __split_lines(input_path, chunk_bytes, start=0, end=None):
+        """Splits bytes [start, end) of a file into ranges of about `chunk_bytes`
+        bytes that begin and end at line boundaries."""
+        size = os.path.getsize(input_path) if end is None else end
+        bounds = [start]
+        with open(input_path, 'rb') as f:
+            for offset in range(start + chunk_bytes, size, chunk_bytes):
+                if offset <= bounds[-1]:
+                    continue
+                # move to the beginning of the next line
+                f.seek(offset - 1)
+                f.readline()
+                if f.tell() < size:
+                    bounds.append(f.tell())
+        bounds.append(size)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def read_binary(self, input_path, start=0, end=None):
+        return self.__load(input_path, self.__read_binary_chunks(input_path, start, end),
+                           start, end)
+
+    def __read_binary_chunks(self, input_path, start=0, end=None):
+        print("Reading binary trace...")
+        if get_compression(input_path) is not None:
+            yield from self.__read_compressed_binary_chunks(input_path)
+            return
+        buf = numpy.memmap(input_path, dtype=numpy.uint8, mode='r')
+        offset = start
+        while offset < (buf.size if end is None else end):
+            header = buf[offset:offset+self.BINARY_HEADER_DTYPE.itemsize] \
+                .view(self.BINARY_HEADER_DTYPE)[0]
+            if header['magic'] != self.BINARY_MAGIC:
+                raise ValueError("{}: invalid binary trace at offset {}".format(input_path, offset))
+            offset += self.BINARY_HEADER_DTYPE.itemsize
+
+            num_kinds, num_records = int(header['num_kinds']), int(header['num_records'])
+            kind_names = []
+            for i in range(num_kinds):
+                length = int(buf[offset:offset+8].view('<u8')[0])
+                kind_names.append(buf[offset+8:offset+8+length].tobytes().decode())
+                offset += 8 + (length + 7) // 8 * 8
+
+            size = num_records * self.BINARY_RECORD_DTYPE.itemsize
+            records = buf[offset:offset+size].view(self.BINARY_RECORD_DTYPE)
+            offset += size
+            for i in range(0, num_records, self.CHUNK_SIZE):
+                r = records[i:i+self.CHUNK_SIZE]
+                yield r['rank0'], r['t0'], r['rank1'], r['t1'], r['kind'], kind_names
+
+    def __read_compressed_binary_chunks(self, input_path):
+        # Same as `__read_binary_chunks`, but blocks are read from the stream in order
+        with open_trace(input_path) as f:
+            offset = 0
+            def read(size, at_block=False):
+                # Reads `size` bytes; the stream may end only at a block boundary,
+                # where empty bytes are returned.
+                nonlocal offset
+                data = f.read(size)
+                while 0 < len(data) < size:
+                    more = f.read(size - len(data))
+                    if not more:
+                        break
+                    data += more
+                if len(data) < size and not (at_block and len(data) == 0):
+                    raise ValueError("{}: truncated binary trace at offset {}"
+                                     .format(input_path, offset + len(data)))
+                offset += len(data)
+                return data
+
+            while True:
+                header_offset = offset
+                data = read(self.BINARY_HEADER_DTYPE.itemsize, at_block=True)
+                if not data:
+                    break
+                header = numpy.frombuffer(data, self.BINARY_HEADER_DTYPE)[0]
+                if header['magic'] != self.BINARY_MAGIC:
+                    raise ValueError("{}: invalid binary trace at offset {}"
+                                     .format(input_path, header_offset))
+
+                num_kinds, num_records = int(header['num_kinds']), int(header['num_records'])
+                kind_names = []
+                for i in range(num_kinds):
+                    length = int(numpy.frombuffer(read(8), '<u8')[0])
+                    kind_names.append(read((length + 7) // 8 * 8)[:length].decode())
+
+                for i in range(0, num_records, self.CHUNK_SIZE):
+                    n = min(self.CHUNK_SIZE, num_records - i)
+                    r = numpy.frombuffer(read(n * self.BINARY_RECORD_DTYPE.itemsize),
+                                         self.BINARY_RECORD_DTYPE)
+                    yield r['rank0'], r['t0'], r['rank1'], r['t1'], r['kind'], kind_names
+
+    def __load(self, input_path, chunks, start=0, end=None):
+        # Events are stored as columnar files on disk and memory-mapped, so that
+        # only pages touched by queries are loaded into memory. The store is kept
+        # as a cache and reused while the source file is unchanged.
+        store_dir = self.__find_store_dir(input_path)
+        if start > 0:
+            return self.__load_private(input_path, chunks)
+        key = dict(self.__get_file_key(input_path, end), version=self.STORE_VERSION)
+        return self.__load_store(input_path, store_dir, key, chunks)
+
+    def __load_private(self, input_path, chunks):
+        # Appended events are read once, so their store is not cached
+        store_dir = self.__find_store_dir(input_path)
+        build_dir = tempfile.mkdtemp(prefix='.mlog-', dir=os.path.dirname(store_dir))
+        atexit.register(shutil.rmtree, build_dir, ignore_errors=True)
+        self.__store_dir = build_dir
+        meta = self.__build_store(input_path, chunks)
+        self.__open_store(build_dir, meta)
+        return self
+
+    def read_traces(self, input_path, traces):
+        """Merges `traces` read from consecutive ranges of `input_path` after its
+        beginning (see `read`) into a store of their own, keeping line numbers.
+        Lanes are assigned to the events of all of them."""
+        def chunks():
+            for trace in traces:
+                yield from trace.__get_chunks_in_line_order()
+        self.__line_offset = traces[0].__line_offset
+        return self.__load_private(input_path, chunks())
+
+    def __get_chunks_in_line_order(self):
+        # events in the order they were read, in the form of chunks of `__load`
+        line = self.__data['line']
+        order = numpy.empty(len(line), dtype=numpy.int64)
+        order[line] = numpy.arange(len(line))
+        for i in range(0, len(order), self.CHUNK_SIZE):
+            rows = order[i:i+self.CHUNK_SIZE]
+            yield (self.__data['rank0'][rows], self.__data['t0'][rows],
+                   self.__data['rank1'][rows], self.__data['t1'][rows],
+                   self.__data['kind'][rows], self.__kinds)
+
+    def remove_store(self):
+        """Removes the store of events read after the beginning of a file (see `read`).
+        The trace can still be queried, as the files stay while they are mapped."""
+        shutil.rmtree(self.__store_dir, ignore_errors=True)
+
+    @staticmethod
+    def __get_file_key(input_path, end=None):
+        stat = os.stat(input_path)
+        return {
+            'path': os.path.abspath(input_path),
+            'size': stat.st_size if end is None else end,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+
+    def __load_store(self, input_path, store_dir, key, chunks):
+        # Processes loading the same trace (e.g., viewers started at the same time)
+        # are serialized by locking the (first) trace file, so that the store is
+        # built only once and is not replaced while another process checks it.
+        with open(input_path, 'rb') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            meta = self.__read_store_meta(store_dir)
+            if meta is None or meta['key'] != key:
+                print("Building trace cache in {}...".format(store_dir))
+                build_dir = tempfile.mkdtemp(prefix='.mlog-', dir=os.path.dirname(store_dir))
+                try:
+                    self.__store_dir = build_dir
+                    meta = self.__build_store(input_path, chunks)
+                    meta['key'] = key
+                    with open(self.__store_path('meta.json'), 'w') as f:
+                        json.dump(meta, f)
+                    shutil.rmtree(store_dir, ignore_errors=True)
+                    os.rename(build_dir, store_dir)
+                except:
+                    shutil.rmtree(build_dir, ignore_errors=True)
+                    raise
+            else:
+                print("Using trace cache in {}...".format(store_dir))
+            self.__open_store(store_dir, meta)
+
+        print("Trace is loaded.")
+        return self
+
+    def __find_store_dir(self, input_path):
+        # The store is placed next to the trace file if possible, or in the user's
+        # cache directory otherwise.
+        store_dir = os.path.abspath(input_path) + self.STORE_SUFFIX
+        if os.access(os.path.dirname(store_dir), os.W_OK):
+            return store_dir
+        cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        cache_dir = os.path.join(cache_home, 'massivelogger')
+        os.makedirs(cache_dir, exist_ok=True)
+        path_hash = hashlib.sha1(os.path.abspath(input_path).encode()).hexdigest()
+        return os.path.join(cache_dir, path_hash + self.STORE_SUFFIX)
+
+    def __read_store_meta(self, store_dir):
+        try:
+            with open(os.path.join(store_dir, 'meta.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __build_store(self, input_path, chunks):
+        # The store is built within `MEMORY_BUDGET`: chunks of events are sorted into
+        # runs on disk, the runs are merged into the store, and lanes and the level
+        # of detail are made for blocks of whole ranks.
+        meta, run_sizes, kind_remap = self.__write_runs(input_path, chunks)
+        self.__merge_runs(run_sizes, kind_remap, meta)
+        print("Assigning lanes...")
+        self.__build_lanes(meta)
+        print("Building level-of-detail data...")
+        meta.update(self.__build_lod(meta))
+        self.__build_samples(meta)
+        return meta
+
+    def __write_runs(self, input_path, chunks):
+        """Writes chunks of events to runs sorted by (rank, duration class, t0).
+
+        Returns the metadata of the trace, the number of events in each run, and the
+        map from ids of kinds in runs to ids in the store.
+        """
+        # Runs are sorted and written in threads while the next chunks are read, and
+        # up to `NUM_READ_WORKERS` runs are in flight.
+        num_threads = self.NUM_READ_WORKERS
+        events_per_run = max(1, self.MEMORY_BUDGET // 2 // self.BYTES_PER_EVENT // num_threads)
+        kind_ids = {}
+        # minimums and maximums of t0, t1, rank0 and rank1 in each chunk
+        extents = []
+        run_sizes = []
+        progress = Progress("Read")
+
+        def runs():
+            pending, num_pending = [], 0
+            num_events = 0
+            for rank0, t0, rank1, t1, codes, kind_names in chunks:
+                # kind ids in each chunk are local; map them to global ones
+                kind_lut = numpy.array([kind_ids.setdefault(k, len(kind_ids))
+                                        for k in kind_names], dtype=numpy.int64)
+                pending.append([numpy.asarray(values, dtype=numpy.int64)
+                                for values in (rank0, t0, rank1, t1, kind_lut[codes])])
+                num_pending += len(t0)
+                num_events += len(t0)
+                if len(t0) > 0:
+                    extents.append((t0.min(), t1.min(), rank0.min(), rank1.min(),
+                                    t0.max(), t1.max(), rank0.max(), rank1.max()))
+                if num_pending >= events_per_run:
+                    yield len(run_sizes), num_events - num_pending, pending
+                    run_sizes.append(num_pending)
+                    pending, num_pending = [], 0
+                progress.add(len(t0))
+            if num_pending > 0:
+                yield len(run_sizes), num_events - num_pending, pending
+                run_sizes.append(num_pending)
+
+        for _ in map_in_threads(self.__write_run, runs(), num_threads):
+            pass
+        progress.finish()
+        num_events = sum(run_sizes)
+        if num_events == 0:
+            raise EmptyTraceError("{}: no events in the trace".format(input_path))
+        extents = numpy.array(extents, dtype=numpy.int64)
+        time_min, _, rank_min, rank1_min = extents[:, :4].min(axis=0)
+        _, time_max, rank_max, rank1_max = extents[:, 4:].max(axis=0)
+
+        # kinds are sorted by name
+        kinds = sorted(kind_ids)
+        kind_remap = numpy.empty(len(kinds), dtype=numpy.int64)
+        kind_remap[[kind_ids[k] for k in kinds]] = numpy.arange(len(kinds))
+        meta = {
+            'kinds': kinds,
+            'time_min': int(time_min),
+            'time_max': int(time_max),
+            'rank_min': int(rank_min),
+            'num_ranks': int(rank_max - rank_min + 1),
+            'rank1_min': int(rank1_min),
+            'rank1_max': int(rank1_max),
+            'num_events': num_events,
+        }
+        return meta, run_sizes, kind_remap
+
+    def __write_run(self, run_id, first_line, chunks):
+        rank0, t0, rank1, t1, kind = (numpy.concatenate(c) for c in zip(*chunks))
+        line = numpy.arange(first_line, first_line + len(t0), dtype=numpy.int64)
+        duration_class = numpy.frexp(numpy.maximum(t1 - t0, 0).astype(numpy.float64))[1]
+        segment = (rank0 - rank0.min()) * self.NUM_DURATION_CLASSES + duration_class
+        if is_lexsorted((t0, segment)):
+            order = None
+        else:
+            # If events are in order of time per rank (e.g., files written per rank,
+            # even if ranks are interleaved), the stable sort by segments keeps them
+            # so, and takes linear time; otherwise, they are sorted by time as well.
+            order = radix_argsort(segment)
+            if not is_lexsorted((t0[order], segment[order])):
+                order = numpy.lexsort((t0, segment))
+        columns = {'rank0': rank0, 'duration_class': duration_class, 't0': t0, 'line': line,
+                   'rank1': rank1, 't1': t1, 'kind': kind}
+        for name in self.RUN_COLUMNS:
+            values = columns[name] if order is None else columns[name][order]
+            values.astype(numpy.int64).tofile(self.__run_path(run_id, name))
+
+    def __run_path(self, run_id, name):
+        return self.__store_path('run{}_{}.tmp'.format(run_id, name))
+
+    def __merge_runs(self, run_sizes, kind_remap, meta):
+        """Merges runs into the columns and the interval index of the store."""
+        num_events = meta['num_events']
+        rank_min = meta['rank_min']
+        runs = [{name: numpy.memmap(self.__run_path(i, name), dtype=numpy.int64, mode='r')
+                 for name in self.RUN_COLUMNS} for i in range(len(run_sizes))]
+        run_sizes = numpy.array(run_sizes, dtype=numpy.int64)
+
+        # Interval index: events are grouped by (rank, duration class) into segments
+        # and sorted by t0 in each segment. An event of a segment overlaps [a, b] only
+        # if its t0 is in [a - (max duration of the segment), b]. Segments of a range
+        # of ranks are contiguous, and kinds are filtered with a mask on candidate
+        # events, so the number of segments does not grow with the number of kinds.
+        def get_segment(rank0, duration_class):
+            return (rank0 - rank_min) * self.NUM_DURATION_CLASSES + duration_class
+
+        # Columns are stored in the smallest integer types holding their values;
+        # only timestamps need 64 bits.
+        dtypes = {
+            'line': smallest_int_dtype(0, num_events - 1),
+            'kind': smallest_int_dtype(0, len(meta['kinds']) - 1),
+            'rank0': smallest_int_dtype(rank_min, rank_min + meta['num_ranks'] - 1),
+            'rank1': smallest_int_dtype(meta['rank1_min'], meta['rank1_max']),
+            't0': numpy.dtype(numpy.int64),
+            't1': numpy.dtype(numpy.int64),
+        }
+        out = {name: numpy.lib.format.open_memmap(self.__store_path(name + '.npy'), mode='w+',
+                                                  dtype=dtype, shape=(num_events,))
+               for name, dtype in dtypes.items()}
+
+        # Blocks of runs are loaded into a buffer, and buffered events up to the
+        # smallest last loaded key of unfinished runs are merged. A run is loaded
+        # again once all its buffered events are merged, so the buffer holds at most
+        # one block of each run.
+        block_size = max(1, self.MEMORY_BUDGET // 2 // self.BYTES_PER_EVENT // len(runs))
+        buffered = {name: numpy.empty(0, dtype=numpy.int64)
+                    for name in self.RUN_COLUMNS + ['run']}
+        num_buffered = numpy.zeros(len(runs), dtype=numpy.int64)
+        loaded = numpy.zeros(len(runs), dtype=numpy.int64)
+        segment_ids, segment_offsets, segment_max_duration = [], [], []
+        num_merged = 0
+        progress = Progress("Merged", num_events)
+        while num_merged < num_events:
+            blocks = [buffered]
+            for i, run in enumerate(runs):
+                if num_buffered[i] == 0 and loaded[i] < run_sizes[i]:
+                    end = min(loaded[i] + block_size, run_sizes[i])
+                    block = {name: numpy.array(run[name][loaded[i]:end])
+                             for name in self.RUN_COLUMNS}
+                    block['run'] = numpy.full(end - loaded[i], i, dtype=numpy.int64)
+                    blocks.append(block)
+                    num_buffered[i] = end - loaded[i]
+                    loaded[i] = end
+            buffered = {name: numpy.concatenate([b[name] for b in blocks]) for name in buffered}
+            del blocks
+            segment = get_segment(buffered['rank0'], buffered['duration_class'])
+            t0, line = buffered['t0'], buffered['line']
+
+            bound = None
+            for i, run in enumerate(runs):
+                if loaded[i] < run_sizes[i]:
+                    k = loaded[i] - 1
+                    key = (get_segment(run['rank0'][k], run['duration_class'][k]),
+                           run['t0'][k], run['line'][k])
+                    bound = key if bound is None else min(bound, key)
+            if bound is None:
+                ready = numpy.ones(len(segment), dtype=bool)
+            else:
+                ready = (segment < bound[0]) | ((segment == bound[0]) & (
+                    (t0 < bound[1]) | ((t0 == bound[1]) & (line <= bound[2]))))
+            idxs = numpy.flatnonzero(ready)
+            idxs = idxs[numpy.lexsort((line[idxs], t0[idxs], segment[idxs]))]
+
+            end = num_merged + len(idxs)
+            out['line'][num_merged:end] = line[idxs]
+            out['kind'][num_merged:end] = kind_remap[buffered['kind'][idxs]]
+            for name in ('rank0', 'rank1', 't0', 't1'):
+                out[name][num_merged:end] = buffered[name][idxs]
+            merged_segment = segment[idxs]
+            duration = numpy.maximum(buffered['t1'][idxs] - t0[idxs], 0)
+            starts = numpy.flatnonzero(numpy.concatenate(
+                ([True], merged_segment[1:] != merged_segment[:-1])))
+            segment_ids.append(merged_segment[starts])
+            segment_offsets.append(num_merged + starts)
+            segment_max_duration.append(numpy.maximum.reduceat(duration, starts))
+
+            num_buffered -= numpy.bincount(buffered['run'][idxs], minlength=len(runs))
+            buffered = {name: values[~ready] for name, values in buffered.items()}
+            num_merged = end
+            progress.add(len(idxs))
+        progress.finish()
+        for values in out.values():
+            values.flush()
+        del out, runs
+        for i in range(len(run_sizes)):
+            for name in self.RUN_COLUMNS:
+                os.remove(self.__run_path(i, name))
+
+        # only nonempty segments are stored; a segment may span merged blocks
+        ids = numpy.concatenate(segment_ids)
+        starts = numpy.flatnonzero(numpy.concatenate(([True], ids[1:] != ids[:-1])))
+        numpy.save(self.__store_path('segment_ids.npy'), ids[starts])
+        numpy.save(self.__store_path('segment_offsets.npy'),
+                   numpy.append(numpy.concatenate(segment_offsets)[starts], num_events))
+        numpy.save(self.__store_path('segment_max_duration.npy'),
+                   numpy.maximum.reduceat(numpy.concatenate(segment_max_duration), starts))
+
+    def __get_rank_blocks(self, meta):
+        """Splits rows of the store into blocks of whole ranks, so that the events of
+        blocks processed by `NUM_READ_WORKERS` threads at a time fit in the memory
+        budget; a rank with more events is a block."""
+        events_per_block = max(1, self.MEMORY_BUDGET // self.BYTES_PER_EVENT //
+                               self.NUM_READ_WORKERS)
+        num_events = meta['num_events']
+        segment_ranks = numpy.load(self.__store_path('segment_ids.npy')) // \
+                        self.NUM_DURATION_CLASSES
+        segment_offsets = numpy.load(self.__store_path('segment_offsets.npy'))
+        rank_starts = segment_offsets[:-1][numpy.concatenate(
+            ([True], segment_ranks[1:] != segment_ranks[:-1]))]
+        cuts = numpy.searchsorted(rank_starts,
+                                  numpy.arange(events_per_block, num_events, events_per_block))
+        bounds = numpy.unique(numpy.concatenate(
+            ([0], rank_starts[cuts[cuts < len(rank_starts)]], [num_events])))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def __build_lanes(self, meta):
+        # Events overlapping in a rank are drawn in separate lanes, and the number of
+        # lanes of each rank is given by the data.
+        rank0, t0, t1 = (numpy.load(self.__store_path(name + '.npy'), mmap_mode='r')
+                         for name in ('rank0', 't0', 't1'))
+        rank_lanes = numpy.ones(meta['num_ranks'], dtype=numpy.int64)
+        lane = numpy.lib.format.open_memmap(self.__store_path('lane.tmp'), mode='w+',
+                                            dtype=numpy.int64, shape=(meta['num_events'],))
+
+        def assign_block_lanes(lo, hi):
+            block_rank = numpy.array(rank0[lo:hi])
+            return lo, hi, block_rank, \
+                assign_lanes(block_rank, numpy.array(t0[lo:hi]), numpy.array(t1[lo:hi]))
+
+        for lo, hi, block_rank, block_lane in map_in_threads(
+                assign_block_lanes, self.__get_rank_blocks(meta), self.NUM_READ_WORKERS):
+            lane[lo:hi] = block_lane
+            starts = numpy.flatnonzero(numpy.concatenate(
+                ([True], block_rank[1:] != block_rank[:-1])))
+            rank_lanes[block_rank[starts] - meta['rank_min']] = \
+                numpy.maximum.reduceat(block_lane, starts) + 1
+        self.__write_column('lane', lane, dtype=smallest_int_dtype(0, rank_lanes.max() - 1))
+        del lane
+        os.remove(self.__store_path('lane.tmp'))
+        numpy.save(self.__store_path('rank_lanes.npy'), rank_lanes)
+
+    def __build_lod(self, meta):
+        num_kinds = len(meta['kinds'])
+        time_min = meta['time_min']
+        span = meta['time_max'] - time_min + 1
+        t0 = numpy.load(self.__store_path('t0.npy'), mmap_mode='r')
+        t1 = numpy.load(self.__store_path('t1.npy'), mmap_mode='r')
+        rank0 = numpy.load(self.__store_path('rank0.npy'), mmap_mode='r')
+        kind = numpy.load(self.__store_path('kind.npy'), mmap_mode='r')
+
+        events_per_rank = max(1, len(t0) // meta['num_ranks'])
+        shift = max(0, math.ceil(math.log2(span * self.LOD_EVENTS_PER_BUCKET / events_per_rank)))
+        bucket_bits = max(1, ((span - 1) >> shift).bit_length())
+        kind_bits = max(1, (num_kinds - 1).bit_length())
+        bucket_mask = (1 << bucket_bits) - 1
+
+        # Each entry is keyed by (rank, bucket, kind) packed into an int64, and keys
+        # are sorted in each level, so that entries of a rank in a window are
+        # contiguous whatever the number of kinds is. Rows of a rank are contiguous
+        # in the store, so entries are made for blocks of whole ranks, and keys of
+        # consecutive blocks are already in order.
+        def make_key(rank, bucket, kind):
+            return (((rank << bucket_bits) | bucket) << kind_bits) | kind
+        entries_per_chunk = max(1, self.MEMORY_BUDGET // self.BYTES_PER_EVENT //
+                                self.NUM_READ_WORKERS)
+
+        def make_block_entries(lo, hi):
+            # events are split into buckets in chunks of about `entries_per_chunk`
+            # entries
+            rel0 = t0[lo:hi] - time_min
+            num_buckets = (numpy.maximum(numpy.maximum(t1[lo:hi] - time_min, rel0) - 1, rel0)
+                           >> shift) - (rel0 >> shift) + 1
+            cuts = numpy.searchsorted(numpy.cumsum(num_buckets), numpy.arange(
+                entries_per_chunk, num_buckets.sum(), entries_per_chunk))
+            del rel0, num_buckets
+            keys, occupancy = [], []
+            for i, j in zip(numpy.concatenate(([lo], lo + cuts)),
+                            numpy.concatenate((lo + cuts, [hi]))):
+                rel0 = t0[i:j] - time_min
+                rel1 = numpy.maximum(t1[i:j] - time_min, rel0)
+                first = rel0 >> shift
+                last = numpy.maximum(rel1 - 1, rel0) >> shift
+                idx = numpy.repeat(numpy.arange(len(rel0)), last - first + 1)
+                bucket = concat_ranges(first, last + 1)
+                occ = numpy.minimum(rel1[idx], (bucket + 1) << shift) - \
+                      numpy.maximum(rel0[idx], bucket << shift)
+                rank = rank0[i:j].astype(numpy.int64) - meta['rank_min']
+                key = make_key(rank[idx], bucket, kind[i:j].astype(numpy.int64)[idx])
+                order = numpy.argsort(key, kind='stable')
+                k, o = reduce_sorted(key[order], occ[order])
+                keys.append(k)
+                occupancy.append(o)
+            key = numpy.concatenate(keys)
+            order = numpy.argsort(key, kind='stable')
+            return reduce_sorted(key[order], numpy.concatenate(occupancy)[order])
+
+        block_sizes = []
+        max_bucket = 0
+        with open(self.__store_path('lod_keys.tmp'), 'wb') as key_file, \
+                open(self.__store_path('lod_occupancy.tmp'), 'wb') as occ_file:
+            for key, occ in map_in_threads(make_block_entries, self.__get_rank_blocks(meta),
+                                           self.NUM_READ_WORKERS):
+                key.tofile(key_file)
+                occ.tofile(occ_file)
+                block_sizes.append(len(key))
+                max_bucket = max(max_bucket, int(((key >> kind_bits) & bucket_mask).max()))
+
+        # Coarser levels halve bucket ids, until all buckets are merged into one.
+        num_levels = max_bucket.bit_length() + 1
+        level0_keys = numpy.memmap(self.__store_path('lod_keys.tmp'), dtype=numpy.int64, mode='r')
+        level0_occ = numpy.memmap(self.__store_path('lod_occupancy.tmp'), dtype=numpy.int64,
+                                  mode='r')
+        level_files = [(open(self.__store_path('lod_keys{}.tmp'.format(level)), 'wb'),
+                        open(self.__store_path('lod_occupancy{}.tmp'.format(level)), 'wb'))
+                       for level in range(1, num_levels)]
+        level_sizes = [len(level0_keys)] + [0] * (num_levels - 1)
+
+        def make_block_levels(lo, hi):
+            key = numpy.array(level0_keys[lo:hi])
+            occ = numpy.array(level0_occ[lo:hi])
+            levels = []
+            for _ in level_files:
+                bucket = (key >> kind_bits) & bucket_mask
+                key = make_key(key >> (kind_bits + bucket_bits), bucket >> 1,
+                               key & ((1 << kind_bits) - 1))
+                order = numpy.argsort(key, kind='stable')
+                key, occ = reduce_sorted(key[order], occ[order])
+                levels.append((key, occ))
+            return levels
+
+        block_offsets = numpy.concatenate(([0], numpy.cumsum(block_sizes)))
+        for levels in map_in_threads(make_block_levels,
+                                     zip(block_offsets[:-1], block_offsets[1:]),
+                                     self.NUM_READ_WORKERS):
+            for level, ((key_file, occ_file), (key, occ)) in \
+                    enumerate(zip(level_files, levels), 1):
+                key.tofile(key_file)
+                occ.tofile(occ_file)
+                level_sizes[level] += len(key)
+        for files in level_files:
+            for f in files:
+                f.close()
+        del level0_keys, level0_occ
+
+        for name in ('lod_keys', 'lod_occupancy'):
+            paths = [self.__store_path(name + '.tmp')] + \
+                    [self.__store_path('{}{}.tmp'.format(name, level))
+                     for level in range(1, num_levels)]
+            out = numpy.lib.format.open_memmap(self.__store_path(name + '.npy'), mode='w+',
+                                               dtype=numpy.int64, shape=(sum(level_sizes),))
+            offset = 0
+            for path in paths:
+                values = numpy.memmap(path, dtype=numpy.int64, mode='r') \
+                    if os.path.getsize(path) > 0 else numpy.empty(0, dtype=numpy.int64)
+                for i in range(0, len(values), self.CHUNK_SIZE):
+                    chunk = values[i:i+self.CHUNK_SIZE]
+                    out[offset:offset+len(chunk)] = chunk
+                    offset += len(chunk)
+                del values
+                os.remove(path)
+            out.flush()
+            del out
+        numpy.save(self.__store_path('lod_offsets.npy'),
+                   numpy.concatenate(([0], numpy.cumsum(level_sizes))))
+        return {'lod_shift': shift, 'lod_bucket_bits': bucket_bits, 'lod_kind_bits': kind_bits}
+
+    def __build_samples(self, meta):
+        # Rows of each level are in the order of the store, so rows in a range of
+        # the store are contiguous in each level.
+        line = numpy.load(self.__store_path('line.npy'), mmap_mode='r')
+        levels = range(self.SAMPLE_MIN_LEVEL, 33)
+        row_dtype = smallest_int_dtype(0, max(0, meta['num_events'] - 1))
+        level_sizes = [0] * len(levels)
+        level_paths = [self.__store_path('sample_rows{}.tmp'.format(level)) for level in levels]
+        level_files = [open(path, 'wb') for path in level_paths]
+        for i in range(0, len(line), self.CHUNK_SIZE):
+            level = priority_level(line_priority(
+                line[i:i+self.CHUNK_SIZE].astype(numpy.int64) + self.__line_offset))
+            for j, min_level in enumerate(levels):
+                rows = (i + numpy.flatnonzero(level >= min_level)).astype(row_dtype)
+                rows.tofile(level_files[j])
+                level_sizes[j] += len(rows)
+        for f in level_files:
+            f.close()
+
+        out = numpy.lib.format.open_memmap(self.__store_path('sample_rows.npy'), mode='w+',
+                                           dtype=row_dtype, shape=(sum(level_sizes),))
+        offset = 0
+        for path, size in zip(level_paths, level_sizes):
+            rows = numpy.memmap(path, dtype=row_dtype, mode='r') if size > 0 else \
+                numpy.empty(0, dtype=row_dtype)
+            for i in range(0, size, self.CHUNK_SIZE):
+                chunk = rows[i:i+self.CHUNK_SIZE]
+                out[offset:offset+len(chunk)] = chunk
+                offset += len(chunk)
+            del rows
+            os.remove(path)
+        out.flush()
+        del out
+        numpy.save(self.__store_path('sample_offsets.npy'),
+                   numpy.concatenate(([0], numpy.cumsum(level_sizes))))
+
+    def __open_store(self, store_dir, meta):
+        self.__store_dir = store_dir
+        self.__kinds = meta['kinds']
+        self.__kind_ids = {kind: i for i, kind in enumerate(self.__kinds)}
+        self.__kind_names = numpy.array(self.__kinds, dtype=object)
+        self.__time_min = meta['time_min']
+        self.__time_max = meta['time_max']
+        self.__rank_min = meta['rank_min']
+        self.__num_ranks = meta['num_ranks']
+        self.__data = {name: numpy.load(self.__store_path(name + '.npy'), mmap_mode='r')
+                       for name in self.STORE_COLUMNS}
+
+        segment_offsets = numpy.load(self.__store_path('segment_offsets.npy'))
+        self.__segment_ranks = numpy.load(self.__store_path('segment_ids.npy')) // \
+                               self.NUM_DURATION_CLASSES + self.__rank_min
+        self.__segment_starts = segment_offsets[:-1]
+        self.__segment_ends = segment_offsets[1:]
+        self.__segment_max_duration = numpy.load(self.__store_path('segment_max_duration.npy'))
+        self.__rank_lanes = numpy.load(self.__store_path('rank_lanes.npy'))
+        # lanes of all ranks numbered in order begin here for each rank
+        self.__lane_offsets = numpy.concatenate(([0], numpy.cumsum(self.__rank_lanes)))
+
+        self.__lod_shift = meta['lod_shift']
+        self.__lod_bucket_bits = meta['lod_bucket_bits']
+        self.__lod_kind_bits = meta['lod_kind_bits']
+        self.__lod_keys = numpy.load(self.__store_path('lod_keys.npy'), mmap_mode='r')
+        self.__lod_occupancy = numpy.load(self.__store_path('lod_occupancy.npy'), mmap_mode='r')
+        self.__lod_offsets = numpy.load(self.__store_path('lod_offsets.npy'))
+        self.__sample_rows = numpy.load(self.__store_path('sample_rows.npy'), mmap_mode='r')
+        self.__sample_offsets = numpy.load(self.__store_path('sample_offsets.npy'))
+
+    def __store_path(self, filename):
+        return os.path.join(self.__store_dir, filename)
+
+    def __write_column(self, name, values, order=None, dtype=numpy.int64):
+        out = numpy.lib.format.open_memmap(
+            self.__store_path(name + '.npy'), mode='w+', dtype=dtype, shape=values.shape)
+        for i in range(0, len(values), self.CHUNK_SIZE):
+            out[i:i+self.CHUNK_SIZE] = values[i:i+self.CHUNK_SIZE] if order is None else \
+                                       values[order[i:i+self.CHUNK_SIZE]]
+        out.flush()
+
+    def get_sampled_time_slice(self, time_range, kinds, num_samples, num_pixels=None,
+                               rank_range=None):
+        """Returns a slice of events overlapping `time_range` and the number of them.
+
+        Only events of ranks in `rank_range` (inclusive; all ranks if None) are
+        considered, so the sample budget is spent on visible ranks.
+
+        If there are more than `num_samples` events and `num_pixels` is given, events
+        are merged into pixel-width runs (or aggregated with the coarsest level of
+        detail that still resolves `num_pixels` pixels if there are too many events);
+        otherwise, `num_samples` events with the lowest `line_priority` are sampled.
+        Since priorities do not depend on the window, events sampled in a window are
+        also sampled in any narrower window, and panning keeps events in common.
+        """
+        print("Making slices...")
+        rank_range = self.__clip_rank_range(rank_range)
+        overlaps = self.__query_overlaps(time_range, rank_range)
+        num_total = self.__count_overlaps(overlaps, kinds)
+
+        if num_total > num_samples and num_pixels is not None:
+            if num_total > self.DECIMATION_MAX_EVENTS:
+                return self.__get_lod_time_slice(time_range, kinds, num_pixels, rank_range), \
+                    num_total
+            rows = self.__get_overlap_rows(overlaps, kinds)
+            return self.__get_decimated_time_slice(rows, time_range, num_pixels), num_total
+
+        # The `num_samples` lowest priorities are those in the highest level with
+        # at least as many events in the window, so the level expected to have
+        # about twice as many events is scanned first.
+        max_level = self.SAMPLE_MIN_LEVEL + len(self.__sample_offsets) - 2
+        level = min(int(num_total // (2 * max(1, num_samples))).bit_length() - 1, max_level)
+        while level >= self.SAMPLE_MIN_LEVEL:
+            rows = self.__get_sample_level_rows(level, time_range, kinds, rank_range)
+            if len(rows) >= num_samples:
+                rows = rows[numpy.argsort(self.__get_priority(rows), kind='stable')[:num_samples]]
+                rows.sort()
+                return TimelineTraceSlice(self.__make_dataframe(rows)), num_total
+            level -= 1
+
+        boundary_rows, range_starts, range_ends = overlaps
+        num_list = range_ends - range_starts
+        num_sum_right = len(boundary_rows) + num_list.cumsum()
+        num_sum_left = num_sum_right - num_list
+        num_overlaps = len(boundary_rows) + int(num_list.sum())
+
+        def to_rows(idxs):
+            # map indices of events of all kinds in the window to rows in the store
+            is_boundary = idxs < len(boundary_rows)
+            range_idxs = idxs[~is_boundary]
+            seg = numpy.searchsorted(num_sum_right, range_idxs, 'right')
+            return numpy.concatenate((boundary_rows[idxs[is_boundary]],
+                                      range_starts[seg] + range_idxs - num_sum_left[seg]))
+
+        # keep the `num_samples` lowest priorities, scanning events chunk by chunk
+        kind_mask = self.__get_kind_mask(kinds)
+        rows = numpy.empty(0, dtype=numpy.int64)
+        priority = numpy.empty(0, dtype=numpy.uint64)
+        for i in range(0, num_overlaps, self.CHUNK_SIZE):
+            chunk_rows = to_rows(numpy.arange(i, min(i + self.CHUNK_SIZE, num_overlaps)))
+            chunk_rows = chunk_rows[kind_mask[self.__data['kind'][chunk_rows]]]
+            rows = numpy.concatenate((rows, chunk_rows))
+            priority = numpy.concatenate((priority, self.__get_priority(chunk_rows)))
+            if len(rows) > num_samples:
+                keep = numpy.argpartition(priority, num_samples)[:num_samples]
+                rows, priority = rows[keep], priority[keep]
+        rows.sort()
+        return TimelineTraceSlice(self.__make_dataframe(rows)), num_total
+
+    def __get_priority(self, rows):
+        return line_priority(self.__data['line'][rows].astype(numpy.int64) + self.__line_offset)
+
+    def __get_sample_level_rows(self, level, time_range, kinds, rank_range):
+        """Returns rows of events of `priority_level` `level` or higher that overlap
+        `time_range`, of ranks in `rank_range` and of `kinds`."""
+        boundary_rows, range_starts, range_ends = self.__query_overlaps(time_range, rank_range)
+        boundary_rows = boundary_rows[priority_level(self.__get_priority(boundary_rows)) >= level]
+        offset = level - self.SAMPLE_MIN_LEVEL
+        level_rows = self.__sample_rows[self.__sample_offsets[offset]:
+                                        self.__sample_offsets[offset+1]]
+        rows = numpy.concatenate((boundary_rows, level_rows[concat_ranges(
+            numpy.searchsorted(level_rows, range_starts, 'left'),
+            numpy.searchsorted(level_rows, range_ends, 'left'))]))
+        return rows[self.__get_kind_mask(kinds)[self.__data['kind'][rows]]]
+
+    def get_preview_time_slice(self, time_range, kinds, num_samples, num_pixels=None,
+                               rank_range=None, preview_pixels=1000):
+        """Returns a quick preview of `get_sampled_time_slice` with the same arguments
+        and the number of events.
+
+        The preview is aggregated with the level of detail over up to `preview_pixels`
+        pixels, few enough that it has at most about `num_samples` entries. None is
+        returned if the slice itself is about as quick to make, i.e., if it has all
+        events or is aggregated with the level of detail anyway.
+        """
+        rank_range = self.__clip_rank_range(rank_range)
+        num_total = self.__count_overlaps(self.__query_overlaps(time_range, rank_range), kinds)
+        if num_total <= num_samples or \
+                (num_pixels is not None and num_total > self.DECIMATION_MAX_EVENTS):
+            return None
+        num_ranks = rank_range[1] - rank_range[0] + 1
+        preview_pixels = max(1, min(preview_pixels, num_samples // num_ranks))
+        return self.__get_lod_time_slice(time_range, kinds, preview_pixels, rank_range), \
+            num_total
+
+    def count_events(self, time_range, kinds, rank_range=None):
+        """Returns the number of events of ranks in `rank_range` overlapping
+        `time_range`, as `get_sampled_time_slice` does."""
+        overlaps = self.__query_overlaps(time_range, self.__clip_rank_range(rank_range))
+        return self.__count_overlaps(overlaps, kinds)
+
+    def __query_overlaps(self, time_range, rank_range):
+        """Finds events of all kinds of ranks in `rank_range` overlapping `time_range`
+        (t0 <= end and t1 >= start).
+
+        Events are returned as rows in the store; events starting before the window
+        are listed in an array, and the others are given as ranges of rows.
+        """
+        start, end = math.ceil(time_range[0]), math.floor(time_range[1])
+        segs = slice(numpy.searchsorted(self.__segment_ranks, rank_range[0], 'left'),
+                     numpy.searchsorted(self.__segment_ranks, rank_range[1], 'right'))
+        seg_ends = self.__segment_ends[segs]
+        t0 = self.__data['t0']
+        lo = segment_searchsorted(t0, self.__segment_starts[segs], seg_ends,
+                                  start - self.__segment_max_duration[segs], 'left')
+        mid = segment_searchsorted(t0, lo, seg_ends, start, 'left')
+        hi = numpy.maximum(segment_searchsorted(t0, mid, seg_ends, end, 'right'), mid)
+
+        # Events in [mid, hi) start in the window, and events in [lo, mid) start
+        # before the window but may still overlap it.
+        boundary_rows = concat_ranges(lo, mid)
+        return boundary_rows[self.__data['t1'][boundary_rows] >= start], mid, hi
+
+    def __count_overlaps(self, overlaps, kinds):
+        """Returns the number of events of `kinds` in `overlaps` found by
+        `__query_overlaps`. Kinds of events are checked chunk by chunk, so that
+        counting takes little memory however many events there are."""
+        boundary_rows, range_starts, range_ends = overlaps
+        num_events = len(boundary_rows) + int((range_ends - range_starts).sum())
+        kind_mask = self.__get_kind_mask(kinds)
+        if kind_mask.all():
+            return num_events
+        kind = self.__data['kind']
+        num_events = int(numpy.count_nonzero(kind_mask[kind[boundary_rows]]))
+        for range_start, range_end in zip(range_starts, range_ends):
+            for i in range(range_start, range_end, self.CHUNK_SIZE):
+                num_events += int(numpy.count_nonzero(
+                    kind_mask[kind[i:min(i + self.CHUNK_SIZE, range_end)]]))
+        return num_events
+
+    def __get_overlap_rows(self, overlaps, kinds):
+        """Returns rows of events of `kinds` in `overlaps` found by `__query_overlaps`."""
+        boundary_rows, range_starts, range_ends = overlaps
+        kind_mask = self.__get_kind_mask(kinds)
+        if kind_mask.all():
+            return numpy.concatenate((boundary_rows, concat_ranges(range_starts, range_ends)))
+        kind = self.__data['kind']
+        rows = [boundary_rows[kind_mask[kind[boundary_rows]]]]
+        for range_start, range_end in zip(range_starts, range_ends):
+            for i in range(range_start, range_end, self.CHUNK_SIZE):
+                j = min(i + self.CHUNK_SIZE, range_end)
+                rows.append(i + numpy.flatnonzero(kind_mask[kind[i:j]]))
+        return numpy.concatenate(rows)
+
+    def __clip_rank_range(self, rank_range):
+        """Clips `rank_range` to ranks in the trace, keeping at least one rank."""
+        rank_max = self.__rank_min + self.__num_ranks - 1
+        if rank_range is None:
+            return self.__rank_min, rank_max
+        lo = min(max(rank_range[0], self.__rank_min), rank_max)
+        return lo, max(min(rank_range[1], rank_max), lo)
+
+    def __get_kind_mask(self, kinds):
+        kind_mask = numpy.zeros(len(self.__kinds), dtype=bool)
+        kind_mask[[self.__kind_ids[k] for k in kinds if k in self.__kind_ids]] = True
+        return kind_mask
+
+    def get_time_raster(self, time_range, kinds, num_pixels, rank_range=None):
+        """Rasterizes events overlapping `time_range` into (# of ranks) x `num_pixels`.
+
+        Rows of the raster are ranks in `rank_range` (all ranks if None), clipped to
+        ranks in the trace. Each pixel holds the index of the kind with the largest
+        occupancy in it (-1 if empty). Returns the raster, the number of events and
+        the pixel width.
+        """
+        print("Making raster...")
+        start, end = math.ceil(time_range[0]), math.floor(time_range[1])
+        pixel_width = max(1, end - start) / num_pixels
+        rank_range = self.__clip_rank_range(rank_range)
+        overlaps = self.__query_overlaps(time_range, rank_range)
+        num_total = self.__count_overlaps(overlaps, kinds)
+
+        if num_total > self.DECIMATION_MAX_EVENTS:
+            cell, kind, _, _, _ = self.__reduce_pixels(
+                *self.__get_lod_pixels(time_range, kinds, num_pixels, rank_range))
+        else:
+            rows = self.__get_overlap_rows(overlaps, kinds)
+            cell, kind, _, _, _ = self.__reduce_pixels(
+                *self.__get_event_pixels(rows, start, pixel_width, num_pixels))
+
+        num_ranks = rank_range[1] - rank_range[0] + 1
+        raster = numpy.full(num_ranks * num_pixels, -1, dtype=numpy.int64)
+        raster[cell - (rank_range[0] - self.__rank_min) * num_pixels] = kind
+        return raster.reshape(num_ranks, num_pixels), num_total, pixel_width
+
+    def __get_event_pixels(self, rows, start, pixel_width, num_pixels, by_lane=False):
+        """Splits events into entries keyed by (rank, pixel, kind), or by (lane,
+        pixel, kind) if `by_lane` is True, where lanes of all ranks are numbered in
+        order (see `__lane_offsets`).
+
+        Returns the keys and the extremes and the occupancy of the entries, relative
+        to `start`; the first and the last pixels of events are partially covered,
+        and pixels between them are fully covered.
+        """
+        num_kinds = len(self.__kinds)
+        end = start + pixel_width * num_pixels
+
+        rank = self.__data['rank0'][rows].astype(numpy.int64) - self.__rank_min
+        if by_lane:
+            rank = self.__lane_offsets[rank] + self.__data['lane'][rows]
+        kind = self.__data['kind'][rows].astype(numpy.int64)
+        c0 = numpy.maximum(self.__data['t0'][rows], start) - start
+        c1 = numpy.minimum(self.__data['t1'][rows], end) - start
+        p0 = numpy.minimum(c0 // pixel_width, num_pixels - 1).astype(numpy.int64)
+        p1 = numpy.minimum(c1 // pixel_width, num_pixels - 1).astype(numpy.int64)
+
+        group = rank * num_kinds + kind
+        idx = numpy.concatenate((numpy.arange(len(rows)), numpy.flatnonzero(p1 > p0)))
+        pixel = numpy.concatenate((p0, p1[p1 > p0]))
+        lo = numpy.maximum(c0[idx], pixel * pixel_width)
+        hi = numpy.minimum(c1[idx], (pixel + 1) * pixel_width)
+        def make_key(group, pixel):
+            return ((group // num_kinds) * num_pixels + pixel) * num_kinds + group % num_kinds
+        keys, los, his, occs = [make_key(group[idx], pixel)], [lo], [hi], [hi - lo]
+
+        # count fully covered pixels with a difference array per (rank, kind)
+        spanning = numpy.flatnonzero(p1 - p0 > 1)
+        groups, group_idxs = numpy.unique(group[spanning], return_inverse=True)
+        block = max(1, self.DECIMATION_BLOCK_SIZE // (num_pixels + 1))
+        for g in range(0, len(groups), block):
+            in_block = (group_idxs >= g) & (group_idxs < g + block)
+            gi, ev = group_idxs[in_block] - g, spanning[in_block]
+            diff = numpy.zeros((min(block, len(groups) - g), num_pixels + 1), dtype=numpy.int64)
+            numpy.add.at(diff, (gi, p0[ev] + 1), 1)
+            numpy.add.at(diff, (gi, p1[ev]), -1)
+            count = diff.cumsum(axis=1)[:, :num_pixels]
+            gi, pixel = numpy.nonzero(count)
+            keys.append(make_key(groups[g+gi], pixel))
+            los.append(pixel * pixel_width)
+            his.append((pixel + 1) * pixel_width)
+            occs.append(count[gi, pixel] * pixel_width)
+
+        return (numpy.concatenate(keys), numpy.concatenate(los),
+                numpy.concatenate(his), numpy.concatenate(occs))
+
+    def __reduce_pixels(self, key, lo, hi, occ):
+        """Reduces entries keyed by (rank, pixel, kind) to (rank, pixel) cells.
+
+        Returns the cells in order, and the dominant kind (with the largest
+        occupancy), the extremes and the total occupancy of each cell.
+        """
+        num_kinds = len(self.__kinds)
+        if len(key) == 0:
+            return key, key, lo, hi, occ
+        order = numpy.argsort(key, kind='stable')
+        key, lo, hi, occ = key[order], lo[order], hi[order], occ[order]
+        starts = numpy.flatnonzero(numpy.concatenate(([True], key[1:] != key[:-1])))
+        key = key[starts]
+        occ = numpy.add.reduceat(occ, starts) if len(starts) > 0 else occ
+        lo = numpy.minimum.reduceat(lo, starts) if len(starts) > 0 else lo
+        hi = numpy.maximum.reduceat(hi, starts) if len(starts) > 0 else hi
+
+        cell, kind = key // num_kinds, key % num_kinds
+        starts = numpy.flatnonzero(numpy.concatenate(([True], cell[1:] != cell[:-1])))
+        ends = numpy.append(starts[1:], len(cell))
+        dominant = numpy.lexsort((occ, cell))[ends - 1]
+        if len(starts) > 0:
+            lo = numpy.minimum.reduceat(lo, starts)
+            hi = numpy.maximum.reduceat(hi, starts)
+            occ = numpy.add.reduceat(occ, starts)
+        return cell[starts], kind[dominant], lo, hi, occ
+
+    def __get_decimated_time_slice(self, rows, time_range, num_pixels):
+        """Merges events into runs of pixels for each lane of ranks (M4-style
+        decimation).
+
+        Each pixel of a lane takes the kind with the largest occupancy in it, and
+        adjacent pixels with the same kind are merged into a run spanning from the
+        earliest start to the latest end of events in it. The result looks the same
+        as drawing all events, and has at most (# of lanes) * `num_pixels` runs.
+        """
+        start, end = math.ceil(time_range[0]), math.floor(time_range[1])
+        pixel_width = max(1, end - start) / num_pixels
+        return TimelineTraceSlice(self.__make_runs(
+            *self.__reduce_pixels(*self.__get_event_pixels(rows, start, pixel_width, num_pixels,
+                                                           by_lane=True)),
+            start, num_pixels, by_lane=True), pixel_width)
+
+    def __make_runs(self, cell, kind, lo, hi, occ, start, num_pixels, by_lane=False):
+        """Merges adjacent (rank, pixel) cells of the same rank and kind into runs,
+        and returns them as rows of a slice; cells are of (lane, pixel) if `by_lane`
+        is True (see `__get_event_pixels`), and runs are placed in their lanes."""
+        new_run = numpy.ones(len(cell), dtype=bool)
+        new_run[1:] = (cell[1:] != cell[:-1] + 1) | \
+                      (cell[1:] // num_pixels != cell[:-1] // num_pixels) | (kind[1:] != kind[:-1])
+        run_starts = numpy.flatnonzero(new_run)
+        run_ends = numpy.append(run_starts[1:], len(cell)) - 1
+        rank = cell[run_starts] // num_pixels
+        lane, num_lanes = 0, 1
+        if by_lane:
+            lane = rank
+            rank = numpy.searchsorted(self.__lane_offsets, lane, 'right') - 1
+            lane = lane - self.__lane_offsets[rank]
+            num_lanes = self.__rank_lanes[rank]
+        rank = rank + self.__rank_min
+
+        df = pandas.DataFrame({
+            'line': -1,
+            'rank0': rank,
+            't0': start + lo[run_starts],
+            'rank1': rank,
+            't1': start + hi[run_ends],
+            'kind': self.__kind_names[kind[run_starts]],
+            'duration': numpy.add.reduceat(occ, run_starts) if len(run_starts) > 0 else occ,
+            'lane': lane,
+            'num_lanes': num_lanes,
+        }, columns=self.SLICE_COLUMNS)
+        return df
+
+    def __query_lod(self, time_range, kinds, num_pixels, rank_range):
+        """Finds entries of the coarsest level of detail that still resolves
+        `num_pixels` pixels in buckets overlapping `time_range` for ranks in
+        `rank_range`.
+
+        Returns the bucket width, and the rank, the bucket, the kind and the
+        occupancy of each entry.
+        """
+        start, end = math.ceil(time_range[0]), math.floor(time_range[1])
+        pixel_width = max(1, (end - start) / num_pixels)
+        num_levels = len(self.__lod_offsets) - 1
+        level = min(max(0, math.floor(math.log2(pixel_width)) - self.__lod_shift), num_levels - 1)
+        shift = self.__lod_shift + level
+
+        # find entries in buckets overlapping the window for each rank, and filter
+        # out hidden kinds
+        max_bucket = (self.__time_max - self.__time_min) >> shift
+        first = min(max(0, (start - self.__time_min) >> shift), max_bucket)
+        last = min(max(0, (end - self.__time_min) >> shift), max_bucket)
+        bucket_bits, kind_bits = self.__lod_bucket_bits, self.__lod_kind_bits
+        ranks = numpy.arange(rank_range[0] - self.__rank_min, rank_range[1] - self.__rank_min + 1,
+                             dtype=numpy.int64)
+        offset = self.__lod_offsets[level]
+        keys = self.__lod_keys[offset:self.__lod_offsets[level+1]]
+        lo = numpy.searchsorted(keys, ((ranks << bucket_bits) | first) << kind_bits, 'left')
+        # `last + 1` may carry into the rank bits, so it is added rather than or-ed
+        hi = numpy.searchsorted(keys, ((ranks << bucket_bits) + last + 1) << kind_bits, 'left')
+        idxs = concat_ranges(lo, hi)
+        key = keys[idxs]
+        kind = key & ((1 << kind_bits) - 1)
+        visible = self.__get_kind_mask(kinds)[kind]
+        key, kind, idxs = key[visible], kind[visible], idxs[visible]
+        occ = self.__lod_occupancy[offset+idxs]
+
+        bucket = (key >> kind_bits) & ((1 << bucket_bits) - 1)
+        rank = (key >> (kind_bits + bucket_bits)) + self.__rank_min
+        return 1 << shift, rank, bucket, kind, occ
+
+    def __get_lod_pixels(self, time_range, kinds, num_pixels, rank_range):
+        """Bins level-of-detail entries into entries keyed by (rank, pixel, kind),
+        in the same form as `__get_event_pixels`."""
+        start, end = math.ceil(time_range[0]), math.floor(time_range[1])
+        pixel_width = max(1, end - start) / num_pixels
+        num_kinds = len(self.__kinds)
+        bucket_width, rank, bucket, kind, occ = \
+            self.__query_lod(time_range, kinds, num_pixels, rank_range)
+
+        # buckets are at most as wide as pixels, so each goes to the pixel of its center
+        lo = (self.__time_min + bucket * bucket_width - start).astype(numpy.float64)
+        pixel = numpy.clip((lo + bucket_width / 2) // pixel_width, 0, num_pixels - 1)
+        key = ((rank - self.__rank_min) * num_pixels + pixel.astype(numpy.int64)) * num_kinds + kind
+        return key, lo, lo + bucket_width, occ.astype(numpy.float64)
+
+    def __get_lod_time_slice(self, time_range, kinds, num_pixels, rank_range):
+        """Merges level-of-detail entries into runs of pixels for each rank, in the
+        same way as `__get_decimated_time_slice` for each lane, so that the slice has
+        at most (# of ranks) * `num_pixels` runs whatever the number of kinds is.
+        The level of detail has no lanes, so runs span whole ranks."""
+        start, end = math.ceil(time_range[0]), math.floor(time_range[1])
+        pixel_width = max(1, end - start) / num_pixels
+        return TimelineTraceSlice(self.__make_runs(
+            *self.__reduce_pixels(*self.__get_lod_pixels(time_range, kinds, num_pixels,
+                                                         rank_range)),
+            start, num_pixels), pixel_width, in_lanes=False)
+
+    def __make_dataframe(self, rows):
+        df = pandas.DataFrame({name: self.__data[name][rows] for name in self.STORE_COLUMNS},
+                              columns=self.SLICE_COLUMNS)
+        df['line'] = df['line'].astype(numpy.int64) + self.__line_offset
+        df['kind'] = self.__kind_names[df['kind'].values]
+        df['duration'] = df['t1']-df['t0']
+        df['num_lanes'] = self.__rank_lanes[df['rank0'].values - self.__rank_min]
+        return df
+
+    def get_empty_time_slice(self):
+        return TimelineTraceSlice(pandas.DataFrame(columns=self.SLICE_COLUMNS))
+
+    def get_time_range(self):
+        return self.__time_min, self.__time_max
+
+    def get_rank_range(self):
+        return self.__rank_min, self.__rank_min + self.__num_ranks - 1
+
+    def get_kinds(self):
+        return list(self.__kinds)
+
+    def get_num_events(self):
+        return len(self.__data['line'])
+
+    def get_rank_lanes(self):
+        """Returns the number of lanes of each rank in the rank range."""
+        return self.__rank_lanes
+
+class FollowedTimelineTrace:
+    """Trace file that is still being written (e.g., flushed periodically by a
+    running job), read as it grows.
+
+    `update` reads only the complete events appended since the last read into a new
+    `TimelineTrace` part, and queries combine the results of the parts. Appended
+    parts are merged like the digits of a binary counter, so that there are only
+    O(log n) parts and each event is merged O(log n) times. Lanes are assigned per
+    part, so recent events in different parts may share lanes until merged.
+    """
+    State = collections.namedtuple(
+        'State', ('parts', 'kinds', 'kind_ids', 'rank_min', 'rank_lanes', 'time_range'))
+
+    def __init__(self, input_path):
+        if get_compression(input_path) is not None:
+            raise ValueError("{}: compressed traces cannot be followed".format(input_path))
+        self.__input_path = input_path
+        self.__end = 0
+        self.__num_events = 0
+        self.__state = None
+        self.__version = 0
+        self.__lock = threading.Lock()
+        if not self.update():
+            raise ValueError("{}: no complete events to read".format(input_path))
+
+    def update(self):
+        """Reads events appended to the file. Returns True if there are new events."""
+        with self.__lock:
+            end = TimelineTrace.find_complete_end(self.__input_path, self.__end)
+            if end <= self.__end:
+                return False
+            if self.__end > 0:
+                print("Reading {} appended bytes...".format(end - self.__end))
+            part = TimelineTrace()
+            try:
+                part.read(self.__input_path, self.__end, end, self.__num_events)
+            except EmptyTraceError:
+                # e.g., only empty lines were appended; other errors (e.g., malformed
+                # lines) are raised, and the range is read again on the next update
+                self.__end = end
+                return False
+            self.__end = end
+            self.__num_events += part.get_num_events()
+            old_state = self.__state
+            parts = list(old_state.parts if old_state is not None else ()) + [part]
+            # The first part (the whole file when it is opened) is kept as it is, and
+            # each appended part is at least twice as large as the next one.
+            merged = []
+            while len(parts) > 2 and \
+                    parts[-2].get_num_events() < 2 * parts[-1].get_num_events():
+                print("Merging appended events...")
+                merged += parts[-2:]
+                parts[-2:] = [TimelineTrace().read_traces(self.__input_path, parts[-2:])]
+            self.__state = self.__make_state(
+                parts, old_state.kinds if old_state is not None else [])
+            self.__version += 1
+            for part in merged:
+                # queries made before still read them until they finish
+                part.remove_store()
+            return True
+
+    def get_version(self):
+        """Returns a number that changes whenever events are added."""
+        return self.__version
+
+    @classmethod
+    def __make_state(cls, parts, kinds):
+        # kinds keep their ids in `kinds`, and new kinds are appended
+        kinds = list(kinds)
+        known_kinds = set(kinds)
+        for part in parts:
+            new_kinds = [k for k in part.get_kinds() if k not in known_kinds]
+            kinds += new_kinds
+            known_kinds.update(new_kinds)
+        global_ids = {kind: i for i, kind in enumerate(kinds)}
+        kind_ids = [numpy.array([global_ids[k] for k in part.get_kinds()], dtype=numpy.int64)
+                    for part in parts]
+
+        rank_min = min(part.get_rank_range()[0] for part in parts)
+        rank_max = max(part.get_rank_range()[1] for part in parts)
+        rank_lanes = numpy.ones(rank_max - rank_min + 1, dtype=numpy.int64)
+        for part in parts:
+            lo = part.get_rank_range()[0] - rank_min
+            view = rank_lanes[lo:lo + len(part.get_rank_lanes())]
+            numpy.maximum(view, part.get_rank_lanes(), out=view)
+
+        time_range = (min(part.get_time_range()[0] for part in parts),
+                      max(part.get_time_range()[1] for part in parts))
+        return cls.State(parts=tuple(parts), kinds=kinds, kind_ids=kind_ids,
+                         rank_min=rank_min, rank_lanes=rank_lanes, time_range=time_range)
+
+    @staticmethod
+    def __get_parts(state, rank_range):
+        """Returns the parts having ranks in `rank_range` and their indices."""
+        if rank_range is None:
+            return list(enumerate(state.parts))
+        return [(i, part) for i, part in enumerate(state.parts)
+                if part.get_rank_range()[0] <= rank_range[1] and
+                rank_range[0] <= part.get_rank_range()[1]]
+
+    def __combine_slices(self, state, results):
+        """Concatenates slices of parts into a slice, with the number of lanes of the
+        whole trace."""
+        slices = [sl for sl, _ in results if sl.size() > 0]
+        if not slices:
+            return self.get_empty_time_slice(), sum(num_total for _, num_total in results)
+        df = pandas.concat([sl.dataframe() for sl in slices], ignore_index=True)
+        in_lanes = numpy.repeat([sl.in_lanes() for sl in slices], [sl.size() for sl in slices])
+        df.loc[in_lanes, 'num_lanes'] = \
+            state.rank_lanes[df.loc[in_lanes, 'rank0'].values - state.rank_min]
+        widths = [sl.bucket_width() for sl in slices if sl.bucket_width() is not None]
+        return TimelineTraceSlice(df, max(widths) if widths else None,
+                                  all(sl.in_lanes() for sl in slices)), \
+            sum(num_total for _, num_total in results)
+
+    def get_sampled_time_slice(self, time_range, kinds, num_samples, num_pixels=None,
+                               rank_range=None):
+        """See `TimelineTrace.get_sampled_time_slice`."""
+        state = self.__state
+        parts = [part for _, part in self.__get_parts(state, rank_range)]
+        results = [part.get_sampled_time_slice(time_range, kinds, num_samples, num_pixels,
+                                               rank_range) for part in parts]
+        num_total = sum(n for _, n in results)
+        if num_total > num_samples and num_pixels is not None:
+            # parts with few events are merged into pixels as well
+            results = [part.get_sampled_time_slice(time_range, kinds, 0, num_pixels,
+                                                   rank_range)
+                       if sl.bucket_width() is None and n > 0 else (sl, n)
+                       for part, (sl, n) in zip(parts, results)]
+        sl, num_total = self.__combine_slices(state, results)
+        if sl.bucket_width() is None:
+            # line numbers are unique across parts, so this is the sample of the
+            # whole trace
+            sl = sl.get_sampled_slice(num_samples)
+        return sl, num_total
+
+    def get_preview_time_slice(self, time_range, kinds, num_samples, num_pixels=None,
+                               rank_range=None, preview_pixels=1000):
+        """See `TimelineTrace.get_preview_time_slice`."""
+        state = self.__state
+        parts = [part for _, part in self.__get_parts(state, rank_range)]
+        # the parts share the budget of the preview
+        previews = [part.get_preview_time_slice(time_range, kinds,
+                                                max(1, num_samples // len(parts)),
+                                                num_pixels, rank_range, preview_pixels)
+                    for part in parts]
+        if all(preview is None for preview in previews):
+            return None
+        # parts without previews are quick to query as they are
+        results = [part.get_sampled_time_slice(time_range, kinds, num_samples, num_pixels,
+                                               rank_range) if preview is None else preview
+                   for part, preview in zip(parts, previews)]
+        return self.__combine_slices(state, results)
+
+    def count_events(self, time_range, kinds, rank_range=None):
+        """See `TimelineTrace.count_events`."""
+        return sum(part.count_events(time_range, kinds, rank_range)
+                   for _, part in self.__get_parts(self.__state, rank_range))
+
+    def get_time_raster(self, time_range, kinds, num_pixels, rank_range=None):
+        """See `TimelineTrace.get_time_raster`. A pixel covered by several parts shows
+        the kind of the first one."""
+        state = self.__state
+        rank_max = state.rank_min + len(state.rank_lanes) - 1
+        if rank_range is None:
+            rank_range = (state.rank_min, rank_max)
+        lo = min(max(rank_range[0], state.rank_min), rank_max)
+        rank_range = (lo, max(min(rank_range[1], rank_max), lo))
+
+        raster = numpy.full((rank_range[1] - rank_range[0] + 1, num_pixels), -1,
+                            dtype=numpy.int64)
+        num_total = 0
+        pixel_width = max(1, math.floor(time_range[1]) - math.ceil(time_range[0])) / num_pixels
+        for i, part in self.__get_parts(state, rank_range):
+            part_raster, part_total, pixel_width = \
+                part.get_time_raster(time_range, kinds, num_pixels, rank_range)
+            num_total += part_total
+            part_lo = max(rank_range[0], part.get_rank_range()[0])
+            rows = raster[part_lo - rank_range[0]:part_lo - rank_range[0] + len(part_raster)]
+            fill = (rows < 0) & (part_raster >= 0)
+            rows[fill] = state.kind_ids[i][part_raster[fill]]
+        return raster, num_total, pixel_width
+
+    def get_empty_time_slice(self):
+        return TimelineTraceSlice(pandas.DataFrame(columns=TimelineTrace.SLICE_COLUMNS))
+
+    def get_time_range(self):
+        return self.__state.time_range
+
+    def get_rank_range(self):
+        state = self.__state
+        return state.rank_min, state.rank_min + len(state.rank_lanes) - 1
+
+    def get_kinds(self):
+        return list(self.__state.kinds)
+
+# Traces loaded in this process, by paths and options; they are only read after
+# loading (or updated in place if followed), so sessions of the viewer share them.
+loaded_traces = {}
+
+def load_trace(paths, follow=False, rank_offsets=None):
+    """Returns the trace of the files `paths` (see `TimelineTrace.read_files`),
+    reading it only the first time in this process.
+
+    If `follow` is True, the trace is a `FollowedTimelineTrace` of a single file,
+    which reads events appended to the file on `update`.
+    """
+    key = (tuple(paths), follow, rank_offsets if rank_offsets in (None, 'auto')
+           else tuple(rank_offsets))
+    if key not in loaded_traces:
+        if follow:
+            if len(paths) != 1 or rank_offsets is not None:
+                raise ValueError("only a single trace file can be followed")
+            trace = FollowedTimelineTrace(paths[0])
+        else:
+            trace = TimelineTrace()
+            trace.read_files(paths, rank_offsets)
+        loaded_traces[key] = trace
+    return loaded_traces[key]
+
+def parse_viewer_args(args):
+    """Parses arguments of the viewer, i.e., trace files (paths or glob patterns)
+    followed by options `--follow` and `--rank-offsets=auto|N,N,...`.
+
+    Returns keyword arguments of `load_trace`, or None if no trace file is given.
+    """
+    kwargs = {'paths': [], 'follow': False, 'rank_offsets': None}
+    for arg in args:
+        if arg == '--follow':
+            kwargs['follow'] = True
+        elif arg.startswith('--rank-offsets='):
+            value = arg[len('--rank-offsets='):]
+            kwargs['rank_offsets'] = value if value == 'auto' else \
+                [int(offset) for offset in value.split(',')]
+        else:
+            kwargs['paths'].append(arg)
+    return kwargs if kwargs['paths'] else None